@@ -0,0 +1,104 @@
+import io
+import os
+import tempfile
+import threading
+import uuid
+from typing import Iterator, Optional
+
+
+class SpilledWriteBuffer:
+    def __init__(self, buffer_dir: str):
+        os.makedirs(buffer_dir, exist_ok=True)
+
+        # Разреженный временный файл: пропуски при записи со смещением не занимают место на диске
+        self.__file = tempfile.TemporaryFile(dir=buffer_dir)
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    def write(self, offset: int, buf: bytes) -> int:
+        with self.__lock:
+            self.__file.seek(offset)
+            self.__file.write(buf)
+
+            self.__size = max(self.__size, offset + len(buf))
+
+        return len(buf)
+
+    def truncate(self, length: int) -> None:
+        with self.__lock:
+            self.__file.truncate(length)
+
+            self.__size = length
+
+    def open_upload_stream(self, fields: dict[str, Optional[str]], filename: str,
+                           chunk_size: int) -> 'MultipartFileStream':
+        self.__file.flush()
+
+        reader = open(os.dup(self.__file.fileno()), 'rb', closefd=True)
+        reader.seek(0)
+
+        return MultipartFileStream(fields, 'file', filename, reader, self.__size, chunk_size)
+
+    def close(self) -> None:
+        self.__file.close()
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+
+class MultipartFileStream:
+    def __init__(self, fields: dict[str, Optional[str]], file_field: str, filename: str,
+                 file: io.BufferedReader, file_size: int, chunk_size: int):
+        self.__boundary = uuid.uuid4().hex
+        self.__file = file
+        self.__file_size = file_size
+        self.__chunk_size = chunk_size
+
+        head = b''
+
+        for name, value in fields.items():
+            if value is None:
+                continue
+
+            head += (f'--{self.__boundary}\r\n'
+                     f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                     f'{value}\r\n').encode('utf-8')
+
+        escaped_filename = filename.replace('\\', '\\\\').replace('"', '%22')
+
+        head += (f'--{self.__boundary}\r\n'
+                 f'Content-Disposition: form-data; name="{file_field}"; filename="{escaped_filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+
+        self.__head = head
+        self.__tail = f'\r\n--{self.__boundary}--\r\n'.encode('utf-8')
+
+        self.__length = len(self.__head) + file_size + len(self.__tail)
+
+    def __len__(self) -> int:
+        return self.__length
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.__boundary}'
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self.__head
+
+        file_left = self.__file_size
+
+        while file_left > 0:
+            chunk = self.__file.read(min(self.__chunk_size, file_left))
+
+            if not chunk:
+                raise IOError('Write buffer is shorter than expected')
+
+            file_left -= len(chunk)
+
+            yield chunk
+
+        yield self.__tail
+
+    def close(self) -> None:
+        self.__file.close()
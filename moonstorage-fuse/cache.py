@@ -1,9 +1,15 @@
 import abc
+import collections
 import dataclasses
 import datetime
+import json
+import logging
 import os
 import shutil
-from typing import Any
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Optional
 
 
 @dataclasses.dataclass
@@ -71,3 +77,254 @@ class CachedFieldsStorageInFiles(CachedFieldsStorage):
     @property
     def cache_dir(self) -> str:
         return self.__cache_dir
+
+
+class BlockCache:
+    CHUNK_PREFIX = 'chunk'
+
+    def __init__(self, cache_dir: str, max_size: int, block_size: int):
+        self.__cache_dir = cache_dir
+        self.__max_size = max_size
+        self.__block_size = block_size
+
+        # Размер блока входит в имя файла: после смены block_size блоки старого размера удаляются при загрузке
+        self.__chunk_prefix = f'{self.CHUNK_PREFIX}-{block_size}'
+
+        self.__blocks: collections.OrderedDict[tuple[str, int], int] = collections.OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.__load_existing_blocks()
+
+    def get_chunk_path(self, cid: str, offset: int, size: int) -> str:
+        return os.path.join(self.__cache_dir, cid, f'{self.__chunk_prefix}:{offset}:{size}')
+
+    def get(self, cid: str, offset: int) -> Optional[bytes]:
+        with self.__lock:
+            size = self.__blocks.get((cid, offset))
+
+            if size is None:
+                self.misses += 1
+
+                return None
+
+            self.__blocks.move_to_end((cid, offset))
+
+        try:
+            with open(self.get_chunk_path(cid, offset, size), 'rb') as f:
+                value = f.read()
+        except (FileNotFoundError,):
+            # Блок мог быть вытеснен другим потоком между проверкой и чтением
+            with self.__lock:
+                self.misses += 1
+
+            return None
+
+        with self.__lock:
+            self.hits += 1
+
+        return value
+
+    def put(self, cid: str, offset: int, value: bytes) -> None:
+        size = len(value)
+
+        if size > self.__max_size:
+            return
+
+        chunk_path = self.get_chunk_path(cid, offset, size)
+
+        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+
+        temp_path = f'{chunk_path}.{threading.get_ident()}.tmp'
+
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+
+        os.replace(temp_path, chunk_path)
+
+        with self.__lock:
+            previous_size = self.__blocks.pop((cid, offset), None)
+
+            if previous_size is not None:
+                self.__size -= previous_size
+
+                if previous_size != size:
+                    self.__remove_chunk_file(cid, offset, previous_size)
+
+            self.__blocks[(cid, offset)] = size
+            self.__size += size
+
+            self.__evict()
+
+    def is_exists(self, cid: str, offset: int) -> bool:
+        with self.__lock:
+            return (cid, offset) in self.__blocks
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    @property
+    def max_size(self) -> int:
+        return self.__max_size
+
+    @property
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'blocks': len(self.__blocks),
+                    'size': self.__size,
+                    'max_size': self.__max_size}
+
+    def clear(self):
+        with self.__lock:
+            self.__blocks.clear()
+            self.__size = 0
+
+            shutil.rmtree(self.__cache_dir, ignore_errors=True)
+            os.makedirs(self.__cache_dir, exist_ok=True)
+
+    def __evict(self) -> None:
+        while self.__size > self.__max_size and self.__blocks:
+            (cid, offset), size = self.__blocks.popitem(last=False)
+
+            self.__size -= size
+
+            self.__remove_chunk_file(cid, offset, size)
+
+    def __remove_chunk_file(self, cid: str, offset: int, size: int) -> None:
+        try:
+            os.remove(self.get_chunk_path(cid, offset, size))
+        except (FileNotFoundError,):
+            pass
+
+    def __load_existing_blocks(self) -> None:
+        # CID неизменяемы, поэтому блоки с прошлых запусков остаются валидными
+        found_blocks = []
+
+        for cid in os.listdir(self.__cache_dir):
+            cid_folder = os.path.join(self.__cache_dir, cid)
+
+            if not os.path.isdir(cid_folder):
+                continue
+
+            for chunk_name in os.listdir(cid_folder):
+                chunk_path = os.path.join(cid_folder, chunk_name)
+
+                try:
+                    prefix, offset, size = chunk_name.split(':')
+
+                    if prefix != self.__chunk_prefix or os.path.getsize(chunk_path) != int(size) \
+                            or int(offset) % self.__block_size != 0 or int(size) > self.__block_size:
+                        raise ValueError(chunk_name)
+
+                    found_blocks.append((os.path.getmtime(chunk_path), cid, int(offset), int(size)))
+                except (ValueError,):
+                    os.remove(chunk_path)
+
+            if not os.listdir(cid_folder):
+                os.rmdir(cid_folder)
+
+        for _, cid, offset, size in sorted(found_blocks):
+            self.__blocks[(cid, offset)] = size
+            self.__size += size
+
+        self.__evict()
+
+        logging.info(f'Block cache loaded: {len(self.__blocks)} blocks, {self.__size} bytes')
+
+
+class SingleFlight:
+    def __init__(self):
+        self.__calls: dict[Hashable, Future] = dict()
+        self.__lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        # Пока запрос по ключу выполняется, остальные вызовы ждут и получают его результат
+        with self.__lock:
+            call = self.__calls.get(key)
+            is_leader = call is None
+
+            if is_leader:
+                call = Future()
+                self.__calls[key] = call
+
+        if not is_leader:
+            return call.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            call.set_exception(e)
+
+            raise
+        else:
+            call.set_result(result)
+
+            return result
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__calls)
+
+
+class MetadataStore:
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+
+        self.__connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.__lock = threading.Lock()
+
+        # put_many вызывается на каждый промах getattr: в WAL с synchronous=NORMAL коммит не ждет fsync,
+        # а при сбое теряются только последние записи, которые все равно перепроверяются по ETag
+        self.__connection.execute('pragma journal_mode=WAL')
+        self.__connection.execute('pragma synchronous=NORMAL')
+
+        with self.__lock, self.__connection:
+            self.__connection.execute('create table if not exists files ('
+                                      '    path text primary key,'
+                                      '    st text not null,'
+                                      '    cid text,'
+                                      '    directory_id integer,'
+                                      '    etag text not null'
+                                      ')')
+
+    def get(self, path: str) -> Optional[tuple[dict, Optional[str], Optional[int], str]]:
+        with self.__lock:
+            row = self.__connection.execute('select st, cid, directory_id, etag from files where path=?',
+                                            (path,)).fetchone()
+
+        if row is None:
+            return None
+
+        st, cid, directory_id, etag = row
+
+        return json.loads(st), cid, directory_id, etag
+
+    def put_many(self, rows: list[tuple[str, dict, Optional[str], Optional[int], str]]) -> None:
+        with self.__lock, self.__connection:
+            self.__connection.executemany('insert or replace into files(path, st, cid, directory_id, etag) '
+                                          'values(?, ?, ?, ?, ?)',
+                                          [(path, json.dumps(st), cid, directory_id, etag)
+                                           for path, st, cid, directory_id, etag in rows])
+
+    def delete(self, path: str) -> None:
+        with self.__lock, self.__connection:
+            self.__connection.execute('delete from files where path=?', (path,))
+
+    def clear(self) -> None:
+        with self.__lock, self.__connection:
+            self.__connection.execute('delete from files')
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
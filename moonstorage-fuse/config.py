@@ -5,3 +5,50 @@ db_host = '172.17.0.1'
 db_port = '5432'
 ipfs_rpc_url = 'http://172.17.0.1:5002'
 ipfs_api_url = 'http://172.17.0.1:8081'
+
+cache_dir = 'cache'
+block_size = 128 * 1024
+block_cache_max_size = 2 * 1024 * 1024 * 1024
+
+read_ahead_workers = 8
+read_ahead_min_blocks = 2
+read_ahead_max_blocks = 64
+
+write_buffer_dir = 'write-buffers'
+upload_chunk_size = 1024 * 1024
+
+write_back = True
+upload_workers = 4
+# Больше закрытых, но еще не загруженных файлов release не ставит в очередь и ждет: каждый держит временный файл
+max_pending_uploads = 64
+# close() ждет загрузки и возвращает ее ошибку. При False close возвращается сразу,
+# а ошибка загрузки придет в следующий flush или fsync этого файла
+wait_on_close = True
+
+metadata_ttl = 2
+
+change_feed = True
+change_feed_read_timeout = 45
+change_feed_retry_interval = 5
+metadata_ttl_with_change_feed = 300
+
+metadata_store = True
+metadata_store_path = f'{cache_dir}/metadata-{username}.sqlite3'
+metadata_revalidate_workers = 2
+
+# None, 'startup' (все роли при монтировании) или 'first_access' (роль при первом обращении).
+# Снимок выгружает все метаданные роли, поэтому включается только для пакетных задач
+metadata_snapshot = None
+
+missing_cache_max_entries = 10000
+
+# Многопоточный режим: libfuse обрабатывает запросы в отдельных потоках, и чтение разных файлов идет параллельно.
+# Метаданные защищены общими блокировками, буферы записи - блокировкой на каждый путь.
+# fuse_workers ограничивает число одновременно выполняемых операций; fuse_threads = False включает однопоточный режим
+fuse_threads = True
+fuse_workers = 16
+
+range_fetch_workers = 8
+
+# Чтение шифротекста напрямую из шлюза IPFS с расшифровкой на клиенте, ключ файла выдается API на короткий срок
+client_side_decryption = False
@@ -0,0 +1,45 @@
+import base64
+import dataclasses
+import datetime
+from typing import Any
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+
+@dataclasses.dataclass
+class FileGrant:
+    cid: str
+    secret_key: bytes
+    iv: bytes
+    file_size: int
+    gateway_url: str
+    until: datetime.datetime
+
+    @staticmethod
+    def from_json(json_dict: dict[str, Any]) -> 'FileGrant':
+        return FileGrant(cid=json_dict['cid'],
+                         secret_key=base64.b64decode(json_dict['secret_key']),
+                         iv=base64.b64decode(json_dict['iv']),
+                         file_size=json_dict['file_size'],
+                         gateway_url=json_dict['gateway_url'],
+                         until=datetime.datetime.now() + datetime.timedelta(seconds=json_dict['expires_in']))
+
+    @property
+    def is_expired(self) -> bool:
+        return datetime.datetime.now() >= self.until
+
+    def get_range_header(self, offset: int, size: int) -> str:
+        # Первые AES.block_size байт объекта в IPFS занимает IV
+        return f'bytes={offset + AES.block_size}-{offset + AES.block_size + size - 1}'
+
+    def decrypt(self, offset: int, chunk: bytes) -> bytes:
+        initial_value = int.from_bytes(self.iv, byteorder='big')
+        counter = Counter.new(128, initial_value=initial_value + offset // AES.block_size)
+
+        decipher = AES.new(self.secret_key, AES.MODE_CTR, counter=counter)
+
+        # Смещение может быть не кратно размеру блока, пропускаем начало ключевого потока
+        decipher.decrypt(bytes(offset % AES.block_size))
+
+        return decipher.decrypt(chunk)
@@ -1,81 +1,340 @@
+import collections
+import contextlib
 import dataclasses
 import datetime
-import os
 import errno
+import json
 import stat
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from stat import S_IFDIR
 from time import time
-from typing import Optional
+from typing import Callable, Iterable, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 from fuse import FUSE, Operations, FuseOSError
 
 import logging
 
 import config
 
-from cache import CachedFieldsStorageInMemory, CachedFieldsStorageInFiles
+from buffers import SpilledWriteBuffer
+from grants import FileGrant
+from cache import CachedFieldsStorageInMemory, CachedFieldsStorageInFiles, BlockCache, MetadataStore, SingleFlight
 
 logging.basicConfig(level=logging.INFO)
 
 session = requests.Session()
+# По умолчанию пул держит 10 соединений: при большем числе потоков лишние соединения закрываются после запроса.
+# Запросы идут из операций FUSE и всех фоновых пулов, плюс поток изменений и загрузка снимка метаданных
+http_adapter = HTTPAdapter(pool_maxsize=config.fuse_workers
+                           + config.upload_workers
+                           + config.read_ahead_workers
+                           + config.range_fetch_workers
+                           + config.metadata_revalidate_workers
+                           + 2)
+session.mount('http://', http_adapter)
+session.mount('https://', http_adapter)
+
+# getfattr -n user.moonstorage.upload_queue_depth <точка монтирования>
+UPLOAD_QUEUE_DEPTH_XATTR = 'user.moonstorage.upload_queue_depth'
 
 
 @dataclasses.dataclass
 class FileInfo:
-    CONTENT_FOLDER = 'cache'
-
     st: dict[str, str | int | bytes]
     cid: Optional[str]
     until: Optional[datetime.datetime] = None
     directory_id: Optional[int] = None
+    etag: Optional[str] = None
 
-    @property
-    def chunks_folder(self) -> str:
-        folder = os.path.join(self.CONTENT_FOLDER, self.cid)
-        os.makedirs(folder, exist_ok=True)
 
-        return folder
+@dataclasses.dataclass
+class DirectoryListing:
+    etag: str
+    names: list[str]
+    until: datetime.datetime
 
-    def get_chunk_path(self, offset: int, size: int) -> str:
-        return os.path.join(self.chunks_folder, f'chunk:{offset}:{size}')
 
-    def write_chunk(self, offset: int, size: int, value: bytes) -> None:
-        with open(self.get_chunk_path(offset, size), 'wb') as f:
-            f.write(value)
+@dataclasses.dataclass
+class ReadAheadState:
+    next_offset: int = 0
+    window: int = 0
 
-    def is_chunk_exists(self, offset: int, size: int):
-        return os.path.exists(self.get_chunk_path(offset, size))
 
-    def get_chunk(self, offset: int, size: int) -> bytes:
-        with open(self.get_chunk_path(offset, size), 'rb') as f:
-            return f.read()
+def make_directory_st() -> dict[str, int | float]:
+    return {
+        'st_mode': S_IFDIR | 0o755,
+        'st_nlink': 2,
+        'st_ctime': time(),  # Время создания
+        'st_mtime': time(),  # Время последнего изменения
+        'st_atime': time(),  # Время последнего доступа
+    }
 
 
-class FilesStorage:
+class PathTree:
+    # Индекс родитель -> дети для точечной инвалидации вместо обхода всех путей.
+    # Промежуточные папки добавляются как узлы, даже если самих путей в индексе нет, чтобы поддерево
+    # находилось целиком. Не потокобезопасен: вызывающий держит свою блокировку
     def __init__(self):
+        self.__paths: set[str] = set()
+        self.__children: dict[str, set[str]] = dict()
+
+    def add(self, path: str) -> None:
+        self.__paths.add(path)
+
+        while True:
+            parent_path = path.rsplit('/', 1)[0]
+
+            if not parent_path:
+                return
+
+            children = self.__children.setdefault(parent_path, set())
+
+            if path in children:
+                return
+
+            children.add(path)
+            path = parent_path
+
+    def remove(self, path: str) -> None:
+        self.__paths.discard(path)
+
+        # Поднимаемся вверх, пока узлы остаются пустыми
+        while path not in self.__paths and path not in self.__children:
+            parent_path = path.rsplit('/', 1)[0]
+
+            if not parent_path:
+                return
+
+            children = self.__children.get(parent_path)
+
+            if children is None or path not in children:
+                return
+
+            children.discard(path)
+
+            if children:
+                return
+
+            del self.__children[parent_path]
+            path = parent_path
+
+    def children(self, path: str) -> list[str]:
+        return [child for child in self.__children.get(path, ()) if child in self.__paths]
+
+    def subtree(self, path: str) -> list[str]:
+        # Сам путь и все его потомки, которые есть в индексе
+        found = []
+        stack = [path]
+
+        while stack:
+            node = stack.pop()
+
+            if node in self.__paths:
+                found.append(node)
+
+            stack.extend(self.__children.get(node, ()))
+
+        return found
+
+    def clear(self) -> None:
+        self.__paths.clear()
+        self.__children.clear()
+
+
+class FilesStorage:
+    def __init__(self, store: Optional[MetadataStore] = None,
+                 on_load: Optional[Callable[[str], None]] = None):
         self.__files: dict[str, FileInfo] = dict()
+        # Индексы для изменений с сервера: путь папки по ее id и дети каждой папки
+        self.__directory_paths: dict[int, str] = dict()
+        self.__tree = PathTree()
+        # Операции со словарем короткие, поэтому одной блокировки достаточно; SQLite читается вне ее
+        self.__lock = threading.RLock()
+
+        self.__store = store
+        self.__on_load = on_load
 
     def is_exists(self, path: str) -> bool:
-        if path not in self.__files:
-            return False
+        self.__load(path)
 
-        file_info = self.__files[path]
+        with self.__lock:
+            file_info = self.__files.get(path)
+
+        if file_info is None:
+            return False
 
         if file_info.until and datetime.datetime.now() >= file_info.until:
             return False
 
         return True
 
+    def get(self, path: str) -> Optional[FileInfo]:
+        # В отличие от is_exists возвращает и устаревшие записи, чтобы их можно было перепроверить по ETag
+        self.__load(path)
+
+        with self.__lock:
+            return self.__files.get(path)
+
+    def update(self, files: dict[str, FileInfo]) -> None:
+        with self.__lock:
+            for path, file_info in files.items():
+                self.__set(path, file_info)
+
+        self.__persist(files)
+
+    def discard(self, path: str) -> None:
+        with self.__lock:
+            self.__pop(path)
+
+        if self.__store is not None:
+            self.__store.delete(path)
+
+    def expire(self, paths: Iterable[str]) -> int:
+        # Запись не удаляется, а помечается устаревшей: ее ETag пригодится при перепроверке
+        now = datetime.datetime.now()
+        expired = 0
+
+        with self.__lock:
+            for path in paths:
+                file_info = self.__files.get(path)
+
+                if file_info is not None and file_info.until is not None:
+                    file_info.until = now
+                    expired += 1
+
+        return expired
+
+    def expire_all(self) -> int:
+        with self.__lock:
+            return self.expire(list(self.__files))
+
+    def find_directory_path(self, directory_id: int) -> Optional[str]:
+        with self.__lock:
+            return self.__directory_paths.get(directory_id)
+
+    def children(self, path: str) -> list[str]:
+        with self.__lock:
+            return self.__tree.children(path)
+
+    def subtree(self, path: str) -> list[str]:
+        with self.__lock:
+            return self.__tree.subtree(path)
+
     def __getitem__(self, path: str) -> FileInfo:
-        return self.__files[path]
+        self.__load(path)
+
+        with self.__lock:
+            return self.__files[path]
 
     def __setitem__(self, path: str, file_info: FileInfo) -> None:
-        self.__files[path] = file_info
+        with self.__lock:
+            self.__set(path, file_info)
+
+        self.__persist({path: file_info})
 
     def __delitem__(self, path: str) -> None:
-        del self.__files[path]
+        with self.__lock:
+            if self.__pop(path) is None:
+                raise KeyError(path)
+
+        if self.__store is not None:
+            self.__store.delete(path)
+
+    def __load(self, path: str) -> None:
+        if self.__store is None:
+            return
+
+        with self.__lock:
+            if path in self.__files:
+                return
+
+        stored = self.__store.get(path)
+
+        if stored is None:
+            return
+
+        st, cid, directory_id, etag = stored
+
+        with self.__lock:
+            # Пока читали SQLite, другой поток мог получить более свежую запись с сервера
+            if path in self.__files:
+                return
+
+            # Запись с прошлого запуска отдается сразу, а перепроверяется по ETag в фоне
+            self.__set(path, FileInfo(st=st,
+                                      cid=cid,
+                                      until=datetime.datetime.now() + datetime.timedelta(seconds=config.metadata_ttl),
+                                      directory_id=directory_id,
+                                      etag=etag))
+
+        if self.__on_load is not None:
+            self.__on_load(path)
+
+    def __set(self, path: str, file_info: FileInfo) -> None:
+        self.__pop(path)
+
+        self.__files[path] = file_info
+        self.__tree.add(path)
+
+        if file_info.directory_id is not None and stat.S_ISDIR(file_info.st['st_mode']):
+            self.__directory_paths[file_info.directory_id] = path
+
+    def __pop(self, path: str) -> Optional[FileInfo]:
+        file_info = self.__files.pop(path, None)
+
+        if file_info is None:
+            return None
+
+        self.__tree.remove(path)
+
+        if self.__directory_paths.get(file_info.directory_id) == path:
+            del self.__directory_paths[file_info.directory_id]
+
+        return file_info
+
+    def __persist(self, files: dict[str, FileInfo]) -> None:
+        if self.__store is None:
+            return
+
+        # Сохраняются только подтвержденные сервером записи: без ETag их нельзя перепроверить
+        rows = [(path, file_info.st, file_info.cid, file_info.directory_id, file_info.etag)
+                for path, file_info in files.items()
+                if file_info.etag is not None]
+
+        if rows:
+            self.__store.put_many(rows)
+
+
+class PathLocks:
+    def __init__(self):
+        self.__locks: dict[str, tuple[threading.RLock, int]] = dict()
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def hold(self, path: str):
+        with self.__lock:
+            path_lock, holders = self.__locks.get(path, (None, 0))
+
+            if path_lock is None:
+                path_lock = threading.RLock()
+
+            self.__locks[path] = (path_lock, holders + 1)
+
+        try:
+            with path_lock:
+                yield
+        finally:
+            # Блокировка удаляется, когда ее больше никто не ждет, чтобы словарь не рос бесконечно
+            with self.__lock:
+                path_lock, holders = self.__locks[path]
+
+                if holders == 1:
+                    del self.__locks[path]
+                else:
+                    self.__locks[path] = (path_lock, holders - 1)
 
 
 class HTTPApiFilesystem(Operations):
@@ -90,61 +349,612 @@ class HTTPApiFilesystem(Operations):
         # End deprecated
 
         # New files storage implementation, all upper it is deprecated
-        self.__files = FilesStorage()
+        self.__metadata_store = MetadataStore(config.metadata_store_path) if config.metadata_store else None
+
+        self.__revalidate_pool = ThreadPoolExecutor(max_workers=config.metadata_revalidate_workers,
+                                                    thread_name_prefix='revalidate')
+
+        self.__files = FilesStorage(self.__metadata_store, self.__schedule_revalidation)
+        self.__listings: dict[str, DirectoryListing] = dict()
+        self.__missing: collections.OrderedDict[str, datetime.datetime] = collections.OrderedDict()
+        self.__missing_paths = PathTree()
+        self.__listings_lock = threading.RLock()
+
+        self.__workers = threading.BoundedSemaphore(config.fuse_workers)
+        self.__worker_slot = threading.local()
+        self.__path_locks = PathLocks()
+
+        # Одинаковые одновременные запросы процессов на этом узле уходят на сервер один раз
+        self.__lookups = SingleFlight()
+        self.__block_fetches = SingleFlight()
+
+        self.__snapshot_roles: set[str] = set()
+        self.__snapshot_lock = threading.Lock()
+        self.__snapshot_loads = SingleFlight()
+
+        self.__change_feed_connected = threading.Event()
+        self.__change_feed_stopped = threading.Event()
         self.__release_lock = threading.Lock()
 
+        self.__upload_pool = ThreadPoolExecutor(max_workers=config.upload_workers,
+                                                thread_name_prefix='upload')
+        self.__pending_uploads: dict[str, Future] = dict()
+        self.__upload_slots = threading.BoundedSemaphore(config.max_pending_uploads)
+        self.__queued_uploads = 0
+        # Ошибки загрузок хранятся, пока о них не сообщит flush или fsync
+        self.__failed_uploads: dict[str, Exception] = dict()
+        # Пути, в буфер которых писали после последней загрузки
+        self.__dirty_paths: set[str] = set()
+
+        self.__block_cache = BlockCache(config.cache_dir, config.block_cache_max_size, config.block_size)
+
+        self.__read_ahead_pool = ThreadPoolExecutor(max_workers=config.read_ahead_workers,
+                                                    thread_name_prefix='read-ahead')
+        self.__read_ahead_states: dict[str, ReadAheadState] = dict()
+        self.__pending_blocks: dict[tuple[str, int], Future] = dict()
+        self.__read_ahead_lock = threading.RLock()
+
+        self.__range_pool = ThreadPoolExecutor(max_workers=config.range_fetch_workers,
+                                               thread_name_prefix='range-fetch')
+
+        self.__grants: dict[str, FileGrant] = dict()
+        self.__grants_lock = threading.Lock()
+        self.__grant_requests = SingleFlight()
+
+    def __call__(self, op, *args):
+        # libfuse сам создает потоки по числу запросов, поэтому число одновременных операций ограничиваем здесь
+        with self.__workers:
+            self.__worker_slot.held = True
+
+            try:
+                return super().__call__(op, *args)
+            finally:
+                self.__worker_slot.held = False
+
+    @contextlib.contextmanager
+    def __yield_worker_slot(self):
+        # Ожидающая операция отдает слот: иначе fuse_workers одновременных close остановили бы все остальные
+        held = getattr(self.__worker_slot, 'held', False)
+
+        if held:
+            self.__workers.release()
+
+        try:
+            yield
+        finally:
+            if held:
+                self.__workers.acquire()
+
+    def init(self, path):
+        if config.change_feed:
+            threading.Thread(target=self.__watch_changes, name='change-feed', daemon=True).start()
+
+        if config.metadata_snapshot == 'startup':
+            for role in self.readdir('/', None)[2:]:
+                self.__ensure_snapshot(f'/{role}')
+
+    def __ensure_snapshot(self, path: str) -> None:
+        if config.metadata_snapshot is None or path == '/':
+            return
+
+        role = path[1:].split('/')[0]
+
+        with self.__snapshot_lock:
+            if role in self.__snapshot_roles:
+                return
+
+        # Файловые менеджеры проверяют в корне имена вроде .Trash-1000: снимок загружается только для ролей
+        if not self.__is_role(role):
+            return
+
+        # Загрузку роли ждут только обращения к этой же роли, остальные роли не блокируются
+        self.__snapshot_loads.do(role, lambda: self.__snapshot_role(role))
+
+    def __is_role(self, role: str) -> bool:
+        role_path = f'/{role}'
+
+        if self.__files.is_exists(role_path):
+            return True
+
+        if self.__is_missing(role_path):
+            return False
+
+        # Не через getattr: он сам вызывает __ensure_snapshot
+        try:
+            self.__lookups.do(role_path, lambda: self.__lookup(role_path))
+        except (FuseOSError,):
+            return False
+
+        return True
+
+    def __snapshot_role(self, role: str) -> None:
+        with self.__snapshot_lock:
+            if role in self.__snapshot_roles:
+                return
+
+        try:
+            self.__load_snapshot(role)
+        except (Exception,) as e:
+            logging.warning(f'Can"t load metadata snapshot for role {role}: {str(e)}')
+
+        # Повторно после ошибки не пытаемся: обычные getattr/readdir продолжают работать
+        with self.__snapshot_lock:
+            self.__snapshot_roles.add(role)
+
+    def __load_snapshot(self, role: str) -> None:
+        logging.info(f'Loading metadata snapshot for role {role}...')
+
+        root_version = 0
+        directories: dict[int, tuple[Optional[int], str, int]] = dict()
+        files: list[tuple[Optional[int], str, int, str]] = []
+
+        with session.get(f'{self.base_url}/fuse/snapshot',
+                         params={'role': role},
+                         stream=True,
+                         timeout=(2, 30)) as response:
+            if response.status_code != 200:
+                raise Exception(response.content)
+
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+
+                entry = json.loads(line)
+
+                if entry[0] == 'r':
+                    root_version = entry[1]
+                elif entry[0] == 'd':
+                    _, directory_id, parent_directory, name, version = entry
+                    directories[directory_id] = (parent_directory, name, version)
+                else:
+                    _, directory_id, name, file_size, cid = entry
+                    files.append((directory_id, name, file_size, cid))
+
+        # Путь и ETag папки: цепочка версий от корня роли до нее самой, как у /fuse/resolve и /fuse/dir/read/plus
+        directory_paths: dict[Optional[int], str] = {None: f'/{role}'}
+        directory_etags: dict[Optional[int], str] = {None: f'{role}/0.{root_version}'}
+
+        def _resolve(directory_id: int) -> Optional[str]:
+            # Поднимаемся до уже известной папки без рекурсии: глубина дерева не ограничена
+            chain = []
+            chain_ids = set()
+            current_id = directory_id
+
+            while current_id not in directory_paths:
+                # Родитель недоступен пользователю или цепочка зациклена
+                if current_id not in directories or current_id in chain_ids:
+                    return None
+
+                chain.append(current_id)
+                chain_ids.add(current_id)
+                current_id = directories[current_id][0]
+
+            for chain_id in reversed(chain):
+                parent_directory, name, version = directories[chain_id]
+
+                directory_paths[chain_id] = f'{directory_paths[parent_directory]}/{name}'
+                directory_etags[chain_id] = f'{directory_etags[parent_directory]};{chain_id}.{version}'
+
+            return directory_paths[directory_id]
+
+        until = datetime.datetime.now() + datetime.timedelta(seconds=self.__metadata_ttl)
+
+        snapshot_files: dict[str, FileInfo] = dict()
+        listings: dict[Optional[int], list[str]] = {None: []}
+
+        for directory_id, (parent_directory, name, _) in directories.items():
+            if _resolve(directory_id) is None:
+                continue
+
+            snapshot_files[directory_paths[directory_id]] = FileInfo(st=make_directory_st(),
+                                                                     cid=None,
+                                                                     until=until,
+                                                                     directory_id=directory_id,
+                                                                     etag=directory_etags[parent_directory])
+            listings.setdefault(parent_directory, []).append(name)
+            listings.setdefault(directory_id, [])
+
+        for directory_id, name, file_size, cid in files:
+            if directory_id not in directory_paths:
+                continue
+
+            snapshot_files[f'{directory_paths[directory_id]}/{name}'] = FileInfo(st={
+                'st_mode': stat.S_IFREG | 0o644,
+                'st_nlink': 0,
+                'st_size': file_size,
+                'st_ctime': time(),  # Время создания
+                'st_mtime': time(),  # Время последнего изменения
+                'st_atime': time(),  # Время последнего доступа
+            }, cid=cid, until=until, directory_id=None, etag=directory_etags[directory_id])
+            listings[directory_id].append(name)
+
+        self.__files.update(snapshot_files)
+
+        with self.__listings_lock:
+            for directory_id, names in listings.items():
+                self.__listings[directory_paths[directory_id]] = DirectoryListing(etag=directory_etags[directory_id],
+                                                                                  names=names,
+                                                                                  until=until)
+
+        logging.info(f'Metadata snapshot for role {role}: {len(directories)} directories, {len(files)} files')
+
+    @property
+    def __metadata_ttl(self) -> int:
+        # Пока подписка на изменения активна, записи инвалидируются по событиям и могут жить дольше
+        if self.__change_feed_connected.is_set():
+            return config.metadata_ttl_with_change_feed
+
+        return config.metadata_ttl
+
+    def __watch_changes(self) -> None:
+        while not self.__change_feed_stopped.is_set():
+            try:
+                with session.get(f'{self.base_url}/fuse/changes',
+                                 stream=True,
+                                 timeout=(2, config.change_feed_read_timeout)) as response:
+                    if response.status_code != 200:
+                        raise Exception(response.content)
+
+                    # События, пришедшие до подключения, потеряны
+                    self.__expire_all()
+                    self.__change_feed_connected.set()
+
+                    logging.info('Subscribed to metadata changes')
+
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line and line.startswith('data: '):
+                            self.__apply_change(json.loads(line[len('data: '):]))
+            except (Exception,) as e:
+                logging.warning(f'Metadata changes subscription lost: {str(e)}')
+            finally:
+                self.__change_feed_connected.clear()
+                self.__expire_all()
+
+            self.__change_feed_stopped.wait(config.change_feed_retry_interval)
+
+    def __apply_change(self, event: dict) -> None:
+        # Изменились назначения ролей: может появиться или пропасть корень роли вместе со всем содержимым
+        if event['kind'] == 'roles':
+            expired = self.__expire_all()
+
+            logging.info(f'Roles change {event}, expired {expired} entries')
+
+            return
+
+        role = event['role']
+
+        def _get_directory_path(directory_id: Optional[int]) -> Optional[str]:
+            return f'/{role}' if directory_id is None else self.__files.find_directory_path(directory_id)
+
+        parent_paths = {_get_directory_path(event['directory'])}
+
+        if event['op'] == 'update':
+            parent_paths.add(_get_directory_path(event['old_directory']))
+
+        parent_paths.discard(None)
+
+        # Затронуты сами папки и их прямые дети
+        paths = set(parent_paths)
+
+        for parent_path in parent_paths:
+            paths.update(self.__files.children(parent_path))
+
+            with self.__listings_lock:
+                paths.update(self.__missing_paths.children(parent_path))
+
+        # Переименование, перемещение или удаление папки затрагивает все ее содержимое
+        if event['kind'] == 'directory' and event['op'] != 'insert':
+            directory_path = self.__files.find_directory_path(event['id'])
+
+            if directory_path is not None:
+                paths.update(self.__files.subtree(directory_path))
+
+                with self.__listings_lock:
+                    paths.update(self.__missing_paths.subtree(directory_path))
+
+        expired = self.__expire(paths)
+
+        logging.info(f'Metadata change {event}, expired {expired} entries')
+
+    def __schedule_revalidation(self, path: str) -> None:
+        self.__revalidate_pool.submit(self.__revalidate, path)
+
+    def __revalidate(self, path: str) -> None:
+        file_info = self.__files.get(path)
+
+        if file_info is None:
+            return
+
+        # Помечаем запись устаревшей, чтобы getattr отправил If-None-Match
+        file_info.until = datetime.datetime.now()
+
+        try:
+            self.getattr(path)
+        except (FuseOSError,):
+            logging.info(f'Stored metadata for {path} is no longer valid')
+
+    def __expire(self, paths: set[str]) -> int:
+        # Списки есть только у папок, а папка попадает в __files при lookup, который ядро делает до readdir,
+        # поэтому списки ищутся по тем же путям
+        now = datetime.datetime.now()
+
+        with self.__listings_lock:
+            for path in paths:
+                listing = self.__listings.get(path)
+
+                if listing is not None:
+                    listing.until = now
+
+                self.__forget_missing(path)
+
+        return self.__files.expire(paths)
+
+    def __expire_all(self) -> int:
+        now = datetime.datetime.now()
+
+        with self.__listings_lock:
+            for listing in self.__listings.values():
+                listing.until = now
+
+            self.__missing.clear()
+            self.__missing_paths.clear()
+
+        return self.__files.expire_all()
+
+    def __forget_parent_listings(self, *paths: str) -> None:
+        # Список папки, измененной этим клиентом, нельзя отдавать из кэша до перепроверки
+        with self.__listings_lock:
+            for path in paths:
+                self.__listings.pop(path.rsplit('/', 1)[0] or '/', None)
+
+                for missing_path in self.__missing_paths.subtree(path):
+                    self.__forget_missing(missing_path)
+
+    def __forget_missing(self, path: str) -> None:
+        # Вызывается под __listings_lock
+        if self.__missing.pop(path, None) is not None:
+            self.__missing_paths.remove(path)
+
+    def __is_missing(self, path: str) -> bool:
+        now = datetime.datetime.now()
+
+        parent_path, _, name = path.rpartition('/')
+
+        with self.__listings_lock:
+            missing_until = self.__missing.get(path)
+
+            if missing_until is not None:
+                if now < missing_until:
+                    return True
+
+                self.__forget_missing(path)
+
+            parent_listing = self.__listings.get(parent_path or '/')
+
+        # Свежий список родительской папки без этого имени тоже означает, что файла нет
+
+        if parent_listing is not None and now < parent_listing.until:
+            return name not in parent_listing.names
+
+        # Внутри отсутствующей папки тоже ничего нет
+        return parent_path.count('/') > 1 and not self.__files.is_exists(parent_path) and self.__is_missing(parent_path)
+
+    def __remember_missing(self, path: str) -> None:
+        with self.__listings_lock:
+            self.__missing[path] = datetime.datetime.now() + datetime.timedelta(seconds=self.__metadata_ttl)
+            self.__missing.move_to_end(path)
+            self.__missing_paths.add(path)
+
+            while len(self.__missing) > config.missing_cache_max_entries:
+                evicted_path, _ = self.__missing.popitem(last=False)
+
+                self.__missing_paths.remove(evicted_path)
+
     def getattr(self, path, fh=None):
         logging.info(f"getattr called for path: {path}")
 
         if path == '/':
             return dict(st_mode=(S_IFDIR | 0o755), st_nlink=2)
 
+        self.__ensure_snapshot(path)
+
         if self.__files.is_exists(path):
             return self.__files[path].st
 
-        try:
-            path_parts = path.split('/')
+        # Редакторы, git и интерпретаторы постоянно проверяют несуществующие имена
+        if self.__is_missing(path):
+            raise FuseOSError(errno.ENOENT)
+
+        return self.__lookups.do(path, lambda: self.__lookup(path))
+
+    def __lookup(self, path: str) -> dict:
+        cached_file_info = self.__files.get(path)
+
+        headers = dict()
+
+        if cached_file_info is not None and cached_file_info.etag is not None:
+            headers['If-None-Match'] = cached_file_info.etag
 
+        try:
             logging.info(f'Trying to get attr for file: {path}...')
 
-            response = session.get(f'{self.base_url}/fuse/info',
-                                   params={'path': path,
-                                           'directory_id':
-                                               self.__files['/'.join(path_parts[:-1])].directory_id
-                                               if len(path_parts) > 2 else None},
+            # Сервер разрешает весь путь одним запросом, id родительских папок не нужны
+            response = session.get(f'{self.base_url}/fuse/resolve',
+                                   params={'path': path},
+                                   headers=headers,
                                    timeout=2)
 
-            if response.status_code != 200:
+            if response.status_code == 404:
+                self.__remember_missing(path)
+
+                if cached_file_info is not None:
+                    self.__files.discard(path)
+
+            if response.status_code not in (200, 304):
                 raise FileNotFoundError(response.content)
         except (Exception,) as e:
             logging.info(f'File {path} not found: {str(e)}')
 
             raise FuseOSError(errno.ENOENT)
 
+        until = datetime.datetime.now() + datetime.timedelta(seconds=self.__metadata_ttl)
+
+        if response.status_code == 304:
+            cached_file_info.until = until
+
+            return cached_file_info.st
+
         file_info = response.json()
 
         logging.info(f'FileInfo for {path}: {file_info}')
 
+        path_parts = path[1:].split('/')
+
+        for depth, ancestor_id in enumerate(file_info['ancestors'], start=2):
+            ancestor_path = '/' + '/'.join(path_parts[:depth])
+
+            if not self.__files.is_exists(ancestor_path):
+                self.__files[ancestor_path] = FileInfo(st=make_directory_st(),
+                                                       cid=None,
+                                                       until=until,
+                                                       directory_id=ancestor_id)
+
         self.__files[path] = FileInfo(st=file_info['st'],
                                       cid=file_info['cid'],
-                                      until=datetime.datetime.now() + datetime.timedelta(seconds=2),
-                                      directory_id=file_info['id'])
+                                      until=until,
+                                      directory_id=file_info['id'],
+                                      etag=response.headers.get('ETag'))
 
         return file_info['st']
 
+    def __get_directory_id(self, path: str) -> Optional[int]:
+        # У корня и папок ролей нет id в directories
+        if path.count('/') <= 1:
+            return None
+
+        self.getattr(path)
+
+        return self.__files[path].directory_id
+
+    def __get_parent_directory_id(self, path: str) -> Optional[int]:
+        return self.__get_directory_id(path.rsplit('/', 1)[0] or '/')
+
     def read(self, path, size, offset, fh):
         logging.info(f'Reading file {path}...')
 
         if path not in self.__required_to_read_files:
             return
 
+        # Файл мог быть закрыт после записи уже после open: читаем загруженную версию, а не предыдущую
+        self.__wait_for_upload(path)
+
         file_info = self.__files[path]
 
+        file_size = file_info.st['st_size']
+        end = min(offset + size, file_size)
+
+        if offset >= end:
+            return b''
+
+        block_size = config.block_size
+
+        block_offsets = list(range(offset - offset % block_size, end, block_size))
+
+        # Блоки большого чтения загружаются параллельно: скорость одного запроса ограничена задержкой, а не каналом
+        other_blocks = [self.__range_pool.submit(self.__get_block, path, file_info.cid, block_offset,
+                                                 min(block_size, file_size - block_offset))
+                        for block_offset in block_offsets[1:]]
+
+        blocks = [self.__get_block(path, file_info.cid, block_offsets[0],
+                                   min(block_size, file_size - block_offsets[0]))]
+        blocks += [other_block.result() for other_block in other_blocks]
+
+        result = bytearray()
+
+        for block_offset, block in zip(block_offsets, blocks):
+            result += block[max(offset - block_offset, 0):end - block_offset]
+
+        self.__read_ahead(path, file_info.cid, offset, end, file_size)
+
+        return bytes(result)
+
+    def __read_ahead(self, path: str, cid: str, offset: int, end: int, file_size: int) -> None:
+        block_size = config.block_size
+
+        with self.__read_ahead_lock:
+            state = self.__read_ahead_states.setdefault(path, ReadAheadState())
+
+            # Окно растет при последовательном чтении и сбрасывается при случайном доступе
+            if offset == state.next_offset:
+                state.window = min(max(state.window * 2, config.read_ahead_min_blocks),
+                                   config.read_ahead_max_blocks)
+            else:
+                state.window = 0
+
+            state.next_offset = end
+
+            if state.window == 0:
+                return
+
+            first_block = end + (-end % block_size)
+            last_block = min(first_block + state.window * block_size, file_size)
+
+            for block_offset in range(first_block, last_block, block_size):
+                if (cid, block_offset) in self.__pending_blocks or self.__block_cache.is_exists(cid, block_offset):
+                    continue
+
+                self.__submit_block_fetch(path, cid, block_offset, min(block_size, file_size - block_offset))
+
+    def __submit_block_fetch(self, path: str, cid: str, block_offset: int, block_size: int) -> Future:
+        future = self.__read_ahead_pool.submit(self.__get_block, path, cid, block_offset, block_size)
+
+        self.__pending_blocks[(cid, block_offset)] = future
+
+        def _remove_pending(_future: Future) -> None:
+            with self.__read_ahead_lock:
+                if self.__pending_blocks.get((cid, block_offset)) is _future:
+                    del self.__pending_blocks[(cid, block_offset)]
+
+        future.add_done_callback(_remove_pending)
+
+        return future
+
+    def __get_block(self, path: str, cid: str, block_offset: int, block_size: int) -> bytes:
+        block = self.__block_cache.get(cid, block_offset)
+
+        if block is not None:
+            return block
+
+        # Чтение присоединяется к уже идущей загрузке блока, в том числе упреждающей
+        return self.__block_fetches.do((cid, block_offset),
+                                       lambda: self.__fetch_block(path, cid, block_offset, block_size))
+
+    def __fetch_block(self, path: str, cid: str, block_offset: int, block_size: int) -> bytes:
+        block = None
+
+        if config.client_side_decryption:
+            try:
+                block = self.__fetch_block_from_gateway(cid, block_offset, block_size)
+            except (Exception,) as e:
+                logging.warning(f'Can"t read {path} from gateway, falling back to API: {e}')
+
+        if block is None:
+            block = self.__fetch_block_from_api(path, cid, block_offset, block_size)
+
+        if len(block) == block_size:
+            self.__block_cache.put(cid, block_offset, block)
+
+        return block
+
+    def __fetch_block_from_api(self, path: str, cid: str, block_offset: int, block_size: int) -> bytes:
         try:
-            response = session.get(f'{self.base_url}/download/{file_info.cid}',
-                                   params={'offset': offset,
-                                           'chunk_size': size},
+            response = session.get(f'{self.base_url}/download/{cid}',
+                                   params={'offset': block_offset,
+                                           'chunk_size': block_size},
                                    timeout=3)
+
+            if response.status_code != 200:
+                raise Exception(response.content)
         except (Exception,) as e:
             logging.error(f'Can"t get chunk for: {path}: {e}')
 
@@ -152,14 +962,55 @@ class HTTPApiFilesystem(Operations):
 
         return response.content
 
+    def __fetch_block_from_gateway(self, cid: str, block_offset: int, block_size: int) -> bytes:
+        grant = self.__get_grant(cid)
+
+        # Шифротекст читается напрямую из шлюза IPFS, API отвечает только за метаданные и выдачу ключа
+        response = session.get(f'{grant.gateway_url}/ipfs/{cid}',
+                               headers={'Range': grant.get_range_header(block_offset, block_size)},
+                               timeout=3)
+
+        if response.status_code != 206:
+            raise Exception(f'Unexpected gateway response: {response.status_code}')
+
+        return grant.decrypt(block_offset, response.content)
+
+    def __get_grant(self, cid: str) -> FileGrant:
+        with self.__grants_lock:
+            grant = self.__grants.get(cid)
+
+        if grant is not None and not grant.is_expired:
+            return grant
+
+        return self.__grant_requests.do(cid, lambda: self.__request_grant(cid))
+
+    def __request_grant(self, cid: str) -> FileGrant:
+        response = session.get(f'{self.base_url}/fuse/file/grant/{cid}', timeout=2)
+
+        if response.status_code != 200:
+            raise Exception(response.content)
+
+        grant = FileGrant.from_json(response.json())
+
+        with self.__grants_lock:
+            # Истекшие гранты удаляются, чтобы ключи не задерживались в памяти
+            for expired_cid in [grant_cid for grant_cid, cached_grant in self.__grants.items()
+                                if cached_grant.is_expired]:
+                del self.__grants[expired_cid]
+
+            self.__grants[cid] = grant
+
+        return grant
+
     def open(self, path, flags):
         logging.info(f'Trying to open a file: {path}...')
 
-        url = f'{self.base_url}/fuse/file/exists'
+        # При отложенной загрузке CID в метаданных меняется только после ее завершения
+        self.__wait_for_upload(path)
 
-        path_parts = path.split('/')
+        url = f'{self.base_url}/fuse/file/exists'
 
-        directory_id = self.__files['/'.join(path_parts[:-1])].directory_id if len(path_parts) > 1 else None
+        directory_id = self.__get_parent_directory_id(path)
 
         response = session.get(url,
                                params={'path': path,
@@ -179,30 +1030,80 @@ class HTTPApiFilesystem(Operations):
     def readdir(self, path, fh):
         logging.info(f'Reading dir: {path}...')
 
-        url = f'{self.base_url}/fuse/dir/read'
+        url = f'{self.base_url}/fuse/dir/read/plus'
+
+        self.__ensure_snapshot(path)
 
         data = dict()
 
         data['path'] = path
 
-        if path != '/' and self.__files[path].directory_id is not None:
-            data['directory_id'] = self.__files[path].directory_id
+        directory_id = self.__get_directory_id(path)
+
+        if directory_id is not None:
+            data['directory_id'] = directory_id
+
+        with self.__listings_lock:
+            cached_listing = self.__listings.get(path)
+
+        if cached_listing is not None and datetime.datetime.now() < cached_listing.until:
+            return ['.', '..'] + cached_listing.names
+
+        headers = dict()
+
+        if cached_listing is not None:
+            headers['If-None-Match'] = cached_listing.etag
 
         try:
             response = session.get(url,
                                    data=data,
+                                   headers=headers,
                                    timeout=2)
 
-            if response.status_code != 200:
+            if response.status_code not in (200, 304):
                 raise Exception(response.content)
         except (Exception,) as e:
             logging.error(f'Can"t read dir {path}: {str(e)}')
 
             raise FuseOSError(errno.EIO)
 
-        logging.info(f'Dir {path} content: {response.json()}')
+        until = datetime.datetime.now() + datetime.timedelta(seconds=self.__metadata_ttl)
+
+        if response.status_code == 304:
+            cached_listing.until = until
 
-        directory_contents = ['.', '..'] + response.json()
+            names = cached_listing.names
+
+            for name in names:
+                child_file_info = self.__files.get(f'{path.rstrip("/")}/{name}')
+
+                if child_file_info is not None:
+                    child_file_info.until = until
+
+            return ['.', '..'] + names
+
+        entries = response.json()
+
+        logging.info(f'Dir {path} content: {[entry["name"] for entry in entries]}')
+
+        etag = response.headers.get('ETag')
+
+        # Сразу заполняем метаданные, чтобы последующие getattr не ходили на сервер.
+        # ETag списка подходит и для дочерних записей: они зависят от тех же папок на пути
+        self.__files.update({f'{path.rstrip("/")}/{entry["name"]}': FileInfo(st=entry['st'],
+                                                                            cid=entry['cid'],
+                                                                            until=until,
+                                                                            directory_id=entry['id'],
+                                                                            etag=etag)
+                             for entry in entries})
+
+        names = [entry['name'] for entry in entries]
+
+        if etag is not None:
+            with self.__listings_lock:
+                self.__listings[path] = DirectoryListing(etag=etag, names=names, until=until)
+
+        directory_contents = ['.', '..'] + names
 
         return directory_contents
 
@@ -218,6 +1119,8 @@ class HTTPApiFilesystem(Operations):
             'st_atime': time(),  # Время последнего доступа
         }, cid=None, until=None)
 
+        self.__forget_parent_listings(path)
+
         return 0
 
     def write(self, path, buf, offset, fh):
@@ -225,71 +1128,236 @@ class HTTPApiFilesystem(Operations):
 
         buffer_path = f'{path}'
 
-        if buffer_path not in self.__buffer_to_write:
-            self.__buffer_to_write[buffer_path] = bytearray()
+        # Буферы разных файлов пишутся параллельно, одного файла - по очереди
+        with self.__path_locks.hold(buffer_path):
+            if buffer_path not in self.__buffer_to_write:
+                self.__buffer_to_write[buffer_path] = SpilledWriteBuffer(config.write_buffer_dir)
+
+            write_buffer = self.__buffer_to_write[buffer_path]
 
-        if len(self.__buffer_to_write[buffer_path]) < offset + len(buf):
-            self.__buffer_to_write[buffer_path].extend(
-                bytearray(offset + len(buf) - len(self.__buffer_to_write[buffer_path])))
+            write_buffer.write(offset, buf)
 
-        self.__buffer_to_write[buffer_path][offset:offset + len(buf)] = buf
+            self.__dirty_paths.add(buffer_path)
 
-        self.__files[path].st['st_size'] += len(buf)
+            self.__files[path].st['st_size'] = write_buffer.size
 
         return len(buf)
 
     def truncate(self, path, length, fh=None):
         path = f'{path}'
 
-        if path not in self.__buffer_to_write:
-            self.__buffer_to_write[path] = bytearray(length)
-        else:
-            self.__buffer_to_write[path] = self.__buffer_to_write[path][:length]
+        with self.__path_locks.hold(path):
+            if path not in self.__buffer_to_write:
+                self.__buffer_to_write[path] = SpilledWriteBuffer(config.write_buffer_dir)
+
+            self.__buffer_to_write[path].truncate(length)
+
+            self.__dirty_paths.add(path)
+
+            if self.__files.is_exists(path):
+                self.__files[path].st['st_size'] = length
 
         return 0
 
     def release(self, path, fh):
         buffer_path = f'{path}'
 
+        with self.__read_ahead_lock:
+            self.__read_ahead_states.pop(path, None)
+
+        # Закрытие разных файлов не ждет друг друга: общая блокировка нужна только для очереди загрузок
+        with self.__path_locks.hold(buffer_path):
+            if buffer_path not in self.__buffer_to_write:
+                return 0
+
+            args = path[1:].split('/')
+
+            if len(args) == 1:
+                raise FuseOSError(errno.EPERM)
+
+            write_buffer = self.__buffer_to_write.pop(buffer_path)
+
+            # Содержимое уже загружено при flush или fsync
+            if buffer_path not in self.__dirty_paths:
+                self.__close_after_uploads(path, write_buffer)
+
+                return 0
+
+            self.__dirty_paths.discard(buffer_path)
+
+            directory_id = self.__get_parent_directory_id(path)
+
+            if not config.write_back:
+                self.__upload_after(None, path, write_buffer, directory_id, close_buffer=True)
+
+                return 0
+
+            self.__queue_upload(path, write_buffer, directory_id, close_buffer=True)
+
+        logging.info(f'File {path} queued for upload, queue depth: {self.upload_queue_depth} '
+                     f'(xattr {UPLOAD_QUEUE_DEPTH_XATTR})')
+
+        return 0
+
+    def flush(self, path, fh):
+        # Ядро вызывает flush при каждом close до release, поэтому загружается текущее содержимое, а не прошлое
+        if config.wait_on_close:
+            self.__sync(path)
+        else:
+            self.__report_failed_upload(path)
+
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        self.__sync(path)
+
+        return 0
+
+    def __sync(self, path: str) -> None:
+        # Блокировка пути не дает писать в буфер, пока его содержимое загружается
+        with self.__path_locks.hold(path):
+            if path in self.__dirty_paths:
+                self.__dirty_paths.discard(path)
+
+                # Буфер остается открытым: в файл можно продолжать писать, а release закроет его после загрузки
+                self.__queue_upload(path, self.__buffer_to_write[path], self.__get_parent_directory_id(path),
+                                    close_buffer=False)
+
+            self.__wait_for_upload(path)
+
+        self.__report_failed_upload(path)
+
+    def __queue_upload(self, path: str, write_buffer: SpilledWriteBuffer, directory_id: Optional[int],
+                       close_buffer: bool) -> Future:
+        # Ограничение очереди: каждая ожидающая загрузка держит временный файл и место на диске
+        with self.__yield_worker_slot():
+            self.__upload_slots.acquire()
+
         with self.__release_lock:
-            if buffer_path in self.__buffer_to_write:
-                url = f'{self.base_url}/upload'
-                args = path[1:].split('/')
+            # Загрузки одного файла выполняются по порядку постановки в очередь
+            previous_upload = self.__pending_uploads.get(path)
 
-                if len(args) == 1:
-                    raise FuseOSError(errno.EPERM)
+            upload = self.__upload_pool.submit(self.__upload_after, previous_upload, path, write_buffer,
+                                               directory_id, close_buffer)
 
-                role = args[0]
+            self.__pending_uploads[path] = upload
+            self.__queued_uploads += 1
 
-                files = {'file': (args[-1],
-                                  self.__buffer_to_write[buffer_path])}
+        def _on_upload_done(_upload: Future) -> None:
+            with self.__release_lock:
+                if self.__pending_uploads.get(path) is _upload:
+                    del self.__pending_uploads[path]
 
-                try:
-                    logging.info(f'Uploading file {path} with role {role}...')
+                self.__queued_uploads -= 1
 
-                    response = session.post(url,
-                                            files=files,
-                                            timeout=30,
-                                            data={'role': role,
-                                                  'directory_id':
-                                                      self.__files[f"/{'/'.join(args[:-1])}"].directory_id
-                                                      if len(args) > 1 else None})
+            self.__upload_slots.release()
 
-                    logging.info(f'File {path} uploaded!')
+        upload.add_done_callback(_on_upload_done)
 
-                    if response.status_code != 200:
-                        raise Exception(response.content.decode('utf-8'))
+        return upload
 
-                except (Exception,) as e:
-                    logging.error(f'Can"t upload file {path}: {str(e)}')
+    def __close_after_uploads(self, path: str, write_buffer: SpilledWriteBuffer) -> None:
+        with self.__release_lock:
+            upload = self.__pending_uploads.get(path)
 
-                    raise FuseOSError(errno.EIO)
+        if upload is None:
+            write_buffer.close()
+        else:
+            upload.add_done_callback(lambda _upload: write_buffer.close())
 
-                self.__files[path].cid = response.json()['cid']
+    def __report_failed_upload(self, path: str) -> None:
+        with self.__release_lock:
+            error = self.__failed_uploads.pop(path, None)
 
-                del self.__buffer_to_write[buffer_path]
+        if error is not None:
+            logging.error(f'Reporting failed upload of {path}: {str(error)}')
 
-            return 0
+            raise FuseOSError(errno.EIO)
+
+    @property
+    def upload_queue_depth(self) -> int:
+        with self.__release_lock:
+            return self.__queued_uploads
+
+    def getxattr(self, path, name, position=0):
+        if name == UPLOAD_QUEUE_DEPTH_XATTR:
+            return str(self.upload_queue_depth).encode('utf-8')
+
+        raise FuseOSError(errno.ENODATA)
+
+    def listxattr(self, path):
+        return [UPLOAD_QUEUE_DEPTH_XATTR]
+
+    def __wait_for_upload(self, path: str) -> None:
+        # Ошибки не поднимаются: о них сообщает __report_failed_upload, для чтения они не фатальны
+        with self.__release_lock:
+            upload = self.__pending_uploads.get(path)
+
+        if upload is None:
+            return
+
+        with self.__yield_worker_slot():
+            try:
+                upload.result()
+            except (Exception,):
+                pass
+
+    def __upload_after(self, previous_upload: Optional[Future], path: str, write_buffer: SpilledWriteBuffer,
+                       directory_id: Optional[int], close_buffer: bool) -> None:
+        if previous_upload is not None:
+            try:
+                previous_upload.result()
+            except (Exception,):
+                # Ошибка предыдущей версии сохранена в __failed_uploads, новая версия загружается независимо
+                pass
+
+        try:
+            self.__upload(path, write_buffer, directory_id, close_buffer)
+        except (Exception,) as e:
+            # Записываем до завершения Future: ожидающий flush должен увидеть ошибку сразу после пробуждения
+            with self.__release_lock:
+                self.__failed_uploads[path] = e
+
+            raise
+
+    def __upload(self, path: str, write_buffer: SpilledWriteBuffer, directory_id: Optional[int],
+                 close_buffer: bool = True) -> None:
+        url = f'{self.base_url}/upload'
+        args = path[1:].split('/')
+
+        role = args[0]
+
+        try:
+            logging.info(f'Uploading file {path} with role {role}...')
+
+            # Тело запроса читается из буфера на диске частями, а не целиком в память
+            with contextlib.closing(write_buffer.open_upload_stream({'role': role,
+                                                          'directory_id': directory_id},
+                                                         args[-1],
+                                                         config.upload_chunk_size)) as upload_stream:
+                response = session.post(url,
+                                        data=upload_stream,
+                                        headers={'Content-Type': upload_stream.content_type},
+                                        timeout=30)
+
+            logging.info(f'File {path} uploaded!')
+
+            if response.status_code != 200:
+                raise Exception(response.content.decode('utf-8'))
+
+        except (Exception,) as e:
+            logging.error(f'Can"t upload file {path}: {str(e)}')
+
+            raise FuseOSError(errno.EIO)
+        finally:
+            if close_buffer:
+                write_buffer.close()
+
+        # Запись могла быть удалена во время загрузки: unlink, rename или обновление списка папки
+        file_info = self.__files.get(path)
+
+        if file_info is not None:
+            file_info.cid = response.json()['cid']
 
     def unlink(self, path):
         logging.info(f'unlink called for path: {path}')
@@ -300,9 +1368,7 @@ class HTTPApiFilesystem(Operations):
         if not self.__files.is_exists(path):
             raise FuseOSError(errno.ENOENT)
 
-        path_parts = path.split('/')
-
-        directory_id = self.__files['/'.join(path_parts[:-1])].directory_id if len(path_parts) > 1 else None
+        directory_id = self.__get_parent_directory_id(path)
 
         # Отправка запроса на сервер для удаления файла
         response = session.post(f'{self.base_url}/delete', data={'path': path,
@@ -315,6 +1381,8 @@ class HTTPApiFilesystem(Operations):
         # Удаление информации о файле из локального кэша
         del self.__files[path]
 
+        self.__forget_parent_listings(path)
+
         logging.info(f'File {path} successfully deleted')
 
     def rename(self, old, new, is_already_renamed: bool = False):
@@ -341,17 +1409,17 @@ class HTTPApiFilesystem(Operations):
 
                 raise FuseOSError(errno.ENOENT)
 
+            self.__forget_parent_listings(old, new)
+
             return
 
-        path_parts = old.split('/')
-        directory_id = self.__files['/'.join(path_parts[:-1])].directory_id if len(path_parts) > 1 else None
+        directory_id = self.__get_parent_directory_id(old)
 
         #  Перемещение файла в другой каталог
         if old.split('/')[:-1] != new.split('/')[:-1]:
             logging.info(f'Move {old} to {new}...')
 
-            path_parts = new.split('/')
-            to_directory_id = self.__files['/'.join(path_parts[:-1])].directory_id if len(path_parts) > 1 else None
+            to_directory_id = self.__get_parent_directory_id(new)
 
             try:
                 response = session.post(f'{self.base_url}/move', params={'filename': old,
@@ -361,6 +1429,8 @@ class HTTPApiFilesystem(Operations):
                 if response.status_code != 200:
                     raise Exception(response.content)
 
+                self.__forget_parent_listings(old, new)
+
                 return
             except (Exception,) as e:
                 logging.error(f'Can"t move file {old}: {str(e)}')
@@ -368,6 +1438,8 @@ class HTTPApiFilesystem(Operations):
         # При попытке загрузить файл
 
         self.release(old, None)
+        self.__wait_for_upload(old)
+        self.__report_failed_upload(old)
 
         # Отправка запроса на сервер для переименования файла
         response = session.put(f'{self.base_url}/rename', params={'old': old,
@@ -386,6 +1458,8 @@ class HTTPApiFilesystem(Operations):
         _remove_if_exists(old)
         _remove_if_exists(new)
 
+        self.__forget_parent_listings(old, new)
+
         logging.info(f'File {old} successfully renamed to {new}')
 
         return 0
@@ -396,13 +1470,9 @@ class HTTPApiFilesystem(Operations):
         if path == '/':
             raise FuseOSError(errno.EIO)
         try:
-            path_parts = path.split('/')
-
             response = session.post(f'{self.base_url}/mkdir',
                                     data={'path': path,
-                                          'directory_id':
-                                              self.__files['/'.join(path_parts[:-1])].directory_id
-                                              if len(path_parts) > 1 else None},
+                                          'directory_id': self.__get_parent_directory_id(path)},
                                     timeout=2)
 
             if response.status_code != 200:
@@ -412,10 +1482,26 @@ class HTTPApiFilesystem(Operations):
 
             raise FuseOSError(errno.EIO)
 
+        self.__forget_parent_listings(path)
+
+    def destroy(self, path):
+        self.__change_feed_stopped.set()
+
+        self.__read_ahead_pool.shutdown(wait=False, cancel_futures=True)
+        self.__range_pool.shutdown(wait=False, cancel_futures=True)
+        self.__revalidate_pool.shutdown(wait=True, cancel_futures=True)
+
+        logging.info(f'Waiting for {self.upload_queue_depth} uploads before unmount...')
+
+        self.__upload_pool.shutdown(wait=True)
+
+        if self.__metadata_store is not None:
+            self.__metadata_store.close()
+
     def rmdir(self, path):
         logging.info(f'rmdir called for path: {path}')
 
-        directory_id = self.__files[path].directory_id
+        directory_id = self.__get_directory_id(path)
 
         try:
             response = session.post(f'{self.base_url}/rmdir',
@@ -429,6 +1515,11 @@ class HTTPApiFilesystem(Operations):
 
             raise FuseOSError(errno.EIO)
 
+        with self.__listings_lock:
+            self.__listings.pop(path, None)
+
+        self.__forget_parent_listings(path)
+
         logging.info(f'Directory {path} successful removed!')
 
         return 0
@@ -453,6 +1544,7 @@ if __name__ == '__main__':
     fuse = FUSE(HTTPApiFilesystem(api_url),
                 './MoonStorage',
                 foreground=True,
+                nothreads=not config.fuse_threads,
                 ro=False,
                 encoding='utf-8'
                 )
@@ -1,28 +1,65 @@
+import base64
+import collections
 import copy
-import datetime
 import json
 import logging
-import os
-import pathlib
+import select
 import stat
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from time import time
 from typing import Callable, NoReturn, Optional
 
 import psycopg2
+import psycopg2.extensions
 from Crypto.Cipher import AES
 from flask import Flask, request, abort, make_response, send_file, after_this_request, Response
-import requests
 
-from helper_classes import ConnectionArgs
+from helper_classes import ConnectionArgs, FileKeys
 
-from utils import auth_utils, security_utils, hash_utils, file_utils
+from utils import auth_utils, security_utils, file_utils, db_utils, cache_utils, upload_utils, ipfs_utils, notify_utils
 
 from decorators import auth_decorators
 
 app = Flask(__name__)
 
 app.config['UPLOAD_FOLDER'] = 'upload/'
+app.config['FILE_KEYS_CACHE_SIZE'] = 10000
+app.config['STREAM_CHUNK_SIZE'] = 1024 * 1024
+app.config['STREAM_TIMEOUT'] = 10
+app.config['STREAM_PART_SIZE'] = 4 * 1024 * 1024
+app.config['STREAM_PARALLEL_PARTS'] = 4
+app.config['RANGE_FETCH_WORKERS'] = 32
+app.config['FILE_GRANTS_ENABLED'] = True
+app.config['FILE_GRANT_TTL'] = 300
+app.config['CHANGES_HEARTBEAT_INTERVAL'] = 15
+app.config['SNAPSHOT_FETCH_SIZE'] = 5000
+app.config['USER_ROLES_CACHE_SIZE'] = 10000
+app.config['USER_ROLES_CACHE_TTL'] = 60
+# Ключи файла выдаются по ролям пользователя, поэтому живут не дольше кэша ролей
+app.config['FILE_KEYS_CACHE_TTL'] = app.config['USER_ROLES_CACHE_TTL']
+
+file_keys_cache = cache_utils.LRUCache(app.config['FILE_KEYS_CACHE_SIZE'], app.config['FILE_KEYS_CACHE_TTL'])
+
+# ConnectionArgs -> роли. Ключ включает пароль: кэш не должен отвечать на запрос, который Postgres бы не авторизовал
+user_roles_cache = cache_utils.LRUCache(app.config['USER_ROLES_CACHE_SIZE'], app.config['USER_ROLES_CACHE_TTL'])
+
+
+def clear_roles_caches() -> None:
+    user_roles_cache.clear()
+    file_keys_cache.clear()
+
+
+# Кэши ролей и ключей сбрасываются при изменении roles_mapping в каждом процессе, а не только в обслуживающих /fuse/changes
+roles_listener = notify_utils.RolesChangeListener(clear_roles_caches)
+
+# Одинаковые одновременные запросы к Postgres и шлюзу IPFS выполняются один раз
+file_keys_requests = cache_utils.SingleFlight()
+user_roles_requests = cache_utils.SingleFlight()
+chunk_requests = cache_utils.SingleFlight()
+
+range_fetch_pool = ThreadPoolExecutor(max_workers=app.config['RANGE_FETCH_WORKERS'],
+                                      thread_name_prefix='range-fetch')
 
 
 class HelperFuncs:
@@ -30,27 +67,34 @@ class HelperFuncs:
     def get_user_roles() -> list:
         connection_args = auth_utils.get_connection_args()
 
-        with psycopg2.connect(dbname="ipfs",
-                              user=connection_args.username,
-                              password=connection_args.password,
-                              host=connection_args.db_host,
-                              port=connection_args.db_port) as connection:
+        roles_listener.ensure_started(connection_args)
+
+        roles = user_roles_cache.get(connection_args)
+
+        if roles is not None:
+            return list(roles)
+
+        return list(user_roles_requests.do(connection_args, lambda: HelperFuncs.load_user_roles(connection_args)))
+
+    @staticmethod
+    def load_user_roles(connection_args: ConnectionArgs) -> tuple:
+        with db_utils.get_connection(connection_args) as connection:
             with connection.cursor() as cursor:
                 cursor.execute('select role from public.user_roles;')
 
-                return [role[0] for role in cursor.fetchall()]
+                roles = tuple(role[0] for role in cursor.fetchall())
+
+        user_roles_cache.set(connection_args, roles)
+
+        return roles
 
     @staticmethod
     def get_files_in_role(role_name: str) -> list:
         connection_args = auth_utils.get_connection_args()
 
-        with psycopg2.connect(dbname="ipfs",
-                              user=connection_args.username,
-                              password=connection_args.password,
-                              host=connection_args.db_host,
-                              port=connection_args.db_port) as connection:
+        with db_utils.get_connection(connection_args) as connection:
             with connection.cursor() as cursor:
-                cursor.execute('select distinct name from registry '
+                cursor.execute('select name from registry_latest '
                                'where role=%s and directory is null', (role_name,))
 
                 files = [file[0] for file in cursor.fetchall()]
@@ -66,18 +110,13 @@ class HelperFuncs:
     def get_file_info_by_name(role: str, filename: str, directory_id: Optional[int] = None) -> dict:
         connection_args = auth_utils.get_connection_args()
 
-        with psycopg2.connect(dbname="ipfs",
-                              user=connection_args.username,
-                              password=connection_args.password,
-                              host=connection_args.db_host,
-                              port=connection_args.db_port) as connection:
+        with db_utils.get_connection(connection_args) as connection:
             with connection.cursor() as cursor:
                 app.logger.info(f'Role: {role}\nFile name:{filename}')
 
                 if directory_id is None:
-                    cursor.execute('select file_size, uploaded_at, cid from registry '
-                                   'where role=%s and name=%s and directory is null'
-                                   ' order by uploaded_at desc', (role, filename))
+                    cursor.execute('select file_size, uploaded_at, cid from registry_latest '
+                                   'where role=%s and name=%s and directory is null', (role, filename))
 
                     found_file = cursor.fetchone()
 
@@ -103,9 +142,8 @@ class HelperFuncs:
                 else:
                     app.logger.info(f'Trying to find file {filename} inside folder with id: {directory_id}')
 
-                    cursor.execute('select file_size, uploaded_at, cid from registry '
-                                   'where role=%s and name=%s and directory=%s'
-                                   ' order by uploaded_at desc', (role, filename, directory_id))
+                    cursor.execute('select file_size, uploaded_at, cid from registry_latest '
+                                   'where role=%s and name=%s and directory=%s', (role, filename, directory_id))
 
                     found_file = cursor.fetchone()
 
@@ -133,11 +171,7 @@ class HelperFuncs:
     def check_if_directory_exists(role: str, directory_name: str) -> bool:
         connection_args = auth_utils.get_connection_args()
 
-        with psycopg2.connect(dbname="ipfs",
-                              user=connection_args.username,
-                              password=connection_args.password,
-                              host=connection_args.db_host,
-                              port=connection_args.db_port) as connection:
+        with db_utils.get_connection(connection_args) as connection:
             with connection.cursor() as cursor:
                 cursor.execute('select count(*) from directories where role=%s and name=%s',
                                (role, directory_name))
@@ -148,11 +182,7 @@ class HelperFuncs:
     def get_directory_id(role: str, directory_name: str, parent_directory: int = None):
         connection_args = auth_utils.get_connection_args()
 
-        with psycopg2.connect(dbname="ipfs",
-                              user=connection_args.username,
-                              password=connection_args.password,
-                              host=connection_args.db_host,
-                              port=connection_args.db_port) as connection:
+        with db_utils.get_connection(connection_args) as connection:
             with connection.cursor() as cursor:
                 if parent_directory is None:
                     cursor.execute('select id from directories '
@@ -172,25 +202,260 @@ class HelperFuncs:
         file_url = f'{connection_args.ipfs_api_url}/ipfs/{file_cid}'
 
         try:
-            requests.get(file_url,
-                         timeout=1,
-                         headers={'Range': f'bytes=0-15'})
+            ipfs_utils.get(file_url,
+                           timeout=1,
+                           headers={'Range': f'bytes=0-15'})
         except (Exception,):
             return False
 
         return True
 
+    @staticmethod
+    def get_directory_entries(role: str, directory_id: Optional[int] = None) -> list:
+        connection_args = auth_utils.get_connection_args()
+
+        with db_utils.get_connection(connection_args) as connection:
+            with connection.cursor() as cursor:
+                # Для корня роли нужен is null: с is not distinct from частичные индексы не используются
+                if directory_id is None:
+                    file_condition, directory_condition = 'directory is null', 'parent_directory is null'
+                    params = (role, role)
+                else:
+                    file_condition, directory_condition = 'directory=%s', 'parent_directory=%s'
+                    params = (role, directory_id, role, directory_id)
+
+                # Текущие версии файлов и вложенные папки одним запросом
+                cursor.execute('select name, file_size, cid, null::bigint, false from registry_latest '
+                               f'where role=%s and {file_condition} '
+                               'union all '
+                               'select name, null, null, id, true from directories '
+                               f'where role=%s and {directory_condition}',
+                               params)
+
+                return [{'name': name,
+                         **(HelperFuncs.make_directory_info(entry_id) if is_dir
+                            else HelperFuncs.make_file_info(file_size, cid))}
+                        for name, file_size, cid, entry_id, is_dir in cursor.fetchall()]
+
+    @staticmethod
+    def make_directory_info(directory_id: Optional[int] = None) -> dict:
+        return {
+            'st': {
+                'st_mode': stat.S_IFDIR | 0o755,
+                'st_nlink': 2,
+                'sn_size': 4096,
+                'st_ctime': time(),  # Время создания
+                'st_mtime': time(),  # Время последнего изменения
+                'st_atime': time(),  # Время последнего доступа
+            },
+            'cid': None,
+            'id': directory_id
+        }
+
+    @staticmethod
+    def make_file_info(file_size: int, cid: str) -> dict:
+        return {
+            'st': {
+                'st_mode': stat.S_IFREG | 0o644,
+                'st_nlink': 0,
+                'st_size': file_size,
+                'st_ctime': time(),  # Время создания
+                'st_mtime': time(),  # Время последнего изменения
+                'st_atime': time(),  # Время последнего доступа
+            },
+            'cid': cid,
+            'id': None,
+        }
+
+    @staticmethod
+    def get_file_keys(file_cid: str) -> Optional[FileKeys]:
+        connection_args = auth_utils.get_connection_args()
+
+        # Доступ к файлу определяется ролями пользователя, поэтому ключ кэша включает его учетные данные
+        cache_key = (file_cid, connection_args)
+
+        roles_listener.ensure_started(connection_args)
+
+        file_keys = file_keys_cache.get(cache_key)
+
+        if file_keys is not None:
+            return file_keys
+
+        return file_keys_requests.do(cache_key, lambda: HelperFuncs.load_file_keys(file_cid, connection_args))
+
+    @staticmethod
+    def load_file_keys(file_cid: str, connection_args: ConnectionArgs) -> Optional[FileKeys]:
+        with db_utils.get_connection(connection_args) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute('select secret_key, file_size from registry '
+                               'where cid=%s '
+                               'order by uploaded_at desc', (file_cid,))
+
+                found_file = cursor.fetchone()
+
+        if not found_file:
+            return None
+
+        try:
+            response_get_iv = ipfs_utils.get(f'{connection_args.ipfs_api_url}/ipfs/{file_cid}',
+                                             headers={'Range': f'bytes=0-{AES.block_size - 1}'})
+        except (Exception,):
+            return None
+
+        iv = response_get_iv.content
+
+        if len(iv) != AES.block_size:
+            return None
+
+        file_keys = FileKeys(secret_key=bytes(found_file[0]),
+                             iv=iv,
+                             file_size=found_file[1])
+
+        file_keys_cache.set((file_cid, connection_args), file_keys)
+
+        return file_keys
+
+    @staticmethod
+    def resolve_path(role: str, path_parts: list[str]) -> dict:
+        connection_args = auth_utils.get_connection_args()
+
+        depth = len(path_parts)
+
+        with db_utils.get_connection(connection_args) as connection:
+            with connection.cursor() as cursor:
+                # Спускаемся по directories от корня роли, затем ищем последнюю версию файла в найденной папке
+                cursor.execute('with recursive walk(depth, id) as ('
+                               '    select 1, id from directories '
+                               '    where role=%(role)s and parent_directory is null '
+                               '    and name=(%(parts)s::varchar[])[1] '
+                               '    union all '
+                               '    select walk.depth + 1, directories.id from walk '
+                               '    join directories on directories.parent_directory=walk.id '
+                               '    and directories.role=%(role)s '
+                               '    and directories.name=(%(parts)s::varchar[])[walk.depth + 1] '
+                               '    where walk.depth < %(depth)s'
+                               '), levels as ('
+                               '    select depth, min(id) as id from walk group by depth'
+                               ') '
+                               'select (select array_agg(id order by depth) from levels where depth < %(depth)s), '
+                               '(select id from levels where depth = %(depth)s), '
+                               'file.file_size, file.cid, '
+                               # Версии папок от корня роли до родителя читаются в том же снимке, что и сам путь
+                               '(select array_agg(coalesce(versions.version, 0) order by chain.depth) from ('
+                               '    select 0 as depth, 0::bigint as id '
+                               '    union all '
+                               '    select depth, id from levels where depth < %(depth)s'
+                               ') as chain '
+                               'left join user_directory_versions as versions '
+                               'on versions.role=%(role)s and versions.directory_id=chain.id) '
+                               'from (select 1) as dummy '
+                               'left join lateral ('
+                               '    select file_size, cid from registry_latest '
+                               '    where role=%(role)s and name=(%(parts)s::varchar[])[%(depth)s] '
+                               # Корень и папка разведены явно: с is not distinct from индекс по directory не используется
+                               '    and ((%(depth)s = 1 and directory is null) '
+                               '         or directory = (select id from levels where depth = %(depth)s - 1))'
+                               ') as file on true',
+                               {'role': role, 'parts': path_parts, 'depth': depth})
+
+                ancestors, leaf_directory_id, file_size, cid, versions = cursor.fetchone()
+
+        ancestors = ancestors or []
+
+        if len(ancestors) != depth - 1:
+            raise FileNotFoundError()
+
+        if cid is not None or file_size is not None:
+            file_info = HelperFuncs.make_file_info(file_size, cid)
+        elif leaf_directory_id is not None:
+            file_info = HelperFuncs.make_directory_info(leaf_directory_id)
+        else:
+            raise FileNotFoundError()
+
+        etag = HelperFuncs.make_etag(role, list(zip([0] + ancestors, versions)))
+
+        return {**file_info, 'ancestors': ancestors}, etag
+
+    @staticmethod
+    def get_directory_versions(role: str, directory_ids: list[int]) -> list[int]:
+        connection_args = auth_utils.get_connection_args()
+
+        with db_utils.get_connection(connection_args) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute('select coalesce(versions.version, 0) '
+                               'from unnest(%s::bigint[]) with ordinality as chain(id, position) '
+                               'left join user_directory_versions as versions '
+                               'on versions.role=%s and versions.directory_id=chain.id '
+                               'order by chain.position', (directory_ids, role))
+
+                return [version[0] for version in cursor.fetchall()]
+
+    @staticmethod
+    def get_directory_chain(role: str, directory_id: Optional[int] = None) -> list[tuple[int, int]]:
+        if directory_id is None:
+            return list(zip([0], HelperFuncs.get_directory_versions(role, [0])))
+
+        connection_args = auth_utils.get_connection_args()
+
+        with db_utils.get_connection(connection_args) as connection:
+            with connection.cursor() as cursor:
+                # Поднимаемся от папки к корню роли и возвращаем версии всех папок на пути
+                cursor.execute('with recursive chain(depth, id, parent_directory) as ('
+                               '    select 1, id, parent_directory from directories '
+                               '    where role=%(role)s and id=%(id)s '
+                               '    union all '
+                               '    select chain.depth + 1, directories.id, directories.parent_directory from chain '
+                               '    join directories on directories.id=chain.parent_directory'
+                               ') '
+                               'select chain.id, coalesce(versions.version, 0) from ('
+                               '    select depth, id from chain '
+                               '    union all '
+                               '    select (select max(depth) + 1 from chain), 0::bigint'
+                               ') as chain '
+                               'left join user_directory_versions as versions '
+                               'on versions.role=%(role)s and versions.directory_id=chain.id '
+                               'order by chain.depth desc',
+                               {'role': role, 'id': directory_id})
+
+                return cursor.fetchall()
+
+    @staticmethod
+    def make_etag(role: str, chain: list[tuple[int, int]]) -> str:
+        return f'{role}/' + ';'.join(f'{directory_id}.{version}' for directory_id, version in chain)
+
+    @staticmethod
+    def get_fresh_etag(role: str, directory_id: Optional[int] = None) -> Optional[str]:
+        # ETag остается верным, пока не изменилась ни одна папка на пути от корня роли
+        for etag in request.if_none_match.as_set():
+            etag_role, _, etag_chain = etag.partition('/')
+
+            if etag_role != role or not etag_chain:
+                continue
+
+            try:
+                chain = [tuple(map(int, item.split('.'))) for item in etag_chain.split(';')]
+            except (ValueError,):
+                continue
+
+            directory_ids = [chain_directory_id for chain_directory_id, _ in chain]
+
+            # ETag списка папки должен заканчиваться на саму эту папку
+            if directory_id is not None and directory_ids[-1] != directory_id:
+                continue
+
+            if HelperFuncs.make_etag(role, list(zip(directory_ids,
+                                                    HelperFuncs.get_directory_versions(role, directory_ids)))) == etag:
+                return etag
+
+        return None
+
     @staticmethod
     def get_files_in_directory(role: str, directory_id: int):
         connection_args = auth_utils.get_connection_args()
 
-        with psycopg2.connect(dbname="ipfs",
-                              user=connection_args.username,
-                              password=connection_args.password,
-                              host=connection_args.db_host,
-                              port=connection_args.db_port) as connection:
+        with db_utils.get_connection(connection_args) as connection:
             with connection.cursor() as cursor:
-                cursor.execute('select distinct name from registry '
+                cursor.execute('select name from registry_latest '
                                'where role=%s and directory=%s', (role, directory_id))
 
                 files = [file[0] for file in cursor.fetchall()]
@@ -270,11 +535,7 @@ def get_my_roles():
 def get_available_files_list():
     connection_args = auth_utils.get_connection_args()
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
+    with db_utils.get_connection(connection_args) as connection:
         with connection.cursor() as cursor:
             cursor.execute('select cid, name, role from registry;')
 
@@ -303,59 +564,40 @@ def upload_file():
 
     logging.info(f'Uploading a new file {file.filename} with role {required_role}...')
 
-    file_extension = pathlib.Path(file.filename).suffix
-
     uploaded_filename = f'{file.filename}'
-    temp_filename = f'{file.filename}{datetime.datetime.now()}{file_extension}'
-
-    temp_path = os.path.join('temp', temp_filename)
-    os.makedirs('temp/', exist_ok=True)
-    file.save(temp_path)
-
-    file_hash = hash_utils.get_hash_of_file(temp_path)
-
-    uploaded_file_size = os.path.getsize(temp_path)
 
     secret_key = security_utils.get_random_aes_key()
 
-    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
+    upload = upload_utils.EncryptedUpload(file.stream, secret_key)
 
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    response = ipfs_utils.post(f'{connection_args.ipfs_rpc_url}/api/v0/add',
+                               data=upload.multipart_body(),
+                               headers={'Content-Type': upload.content_type}).json()
 
-    security_utils.encrypt_file(temp_path,
-                                upload_path,
-                                secret_key)
+    file_hash = upload.file_hash
+    uploaded_file_size = upload.file_size
 
-    os.remove(temp_path)
+    uploaded_file_cid = response['Hash']
 
-    with open(upload_path, 'rb') as f:
-        response = requests.post(f'{connection_args.ipfs_rpc_url}/api/v0/add', files={'file': f}).json()
-
-        uploaded_file_cid = response['Hash']
+    with db_utils.get_connection(connection_args) as connection:
+        with connection.cursor() as cursor:
+            app.logger.debug(uploaded_file_cid)
 
-        with psycopg2.connect(dbname='ipfs',
-                              user=connection_args.username,
-                              password=connection_args.password,
-                              host=connection_args.db_host,
-                              port=connection_args.db_port) as connection:
-            with connection.cursor() as cursor:
-                app.logger.debug(uploaded_file_cid)
-
-                if directory_id:
-                    cursor.execute("insert into registry_data(cid, name, secret_key, role, file_size, file_hash, "
-                                   "directory)"
-                                   "values(%s, %s, %s, %s, %s, %s, %s)",
-                                   (uploaded_file_cid, uploaded_filename, psycopg2.Binary(secret_key), required_role,
-                                    uploaded_file_size, file_hash, directory_id))
-                else:
-                    cursor.execute("insert into registry_data(cid, name, secret_key, role, file_size, file_hash) "
-                                   "values(%s, %s, %s, %s, %s, %s)",
-                                   (uploaded_file_cid, uploaded_filename, psycopg2.Binary(secret_key), required_role,
-                                    uploaded_file_size, file_hash))
+            if directory_id:
+                cursor.execute("insert into registry_data(cid, name, secret_key, role, file_size, file_hash, "
+                               "directory)"
+                               "values(%s, %s, %s, %s, %s, %s, %s)",
+                               (uploaded_file_cid, uploaded_filename, psycopg2.Binary(secret_key), required_role,
+                                uploaded_file_size, file_hash, directory_id))
+            else:
+                cursor.execute("insert into registry_data(cid, name, secret_key, role, file_size, file_hash) "
+                               "values(%s, %s, %s, %s, %s, %s)",
+                               (uploaded_file_cid, uploaded_filename, psycopg2.Binary(secret_key), required_role,
+                                uploaded_file_size, file_hash))
 
-                return {'cid': uploaded_file_cid,
-                        'size': uploaded_file_size,
-                        'hash': file_hash}
+            return {'cid': uploaded_file_cid,
+                    'size': uploaded_file_size,
+                    'hash': file_hash}
 
 
 @app.route('/download/<file_cid>', methods=['GET'])
@@ -363,56 +605,169 @@ def upload_file():
 def get_file(file_cid: str):
     connection_args = auth_utils.get_connection_args()
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
-        with connection.cursor() as cursor:
-            cursor.execute('select name, secret_key, cid from registry '
-                           'where cid=%s '
-                           'order by uploaded_at desc', (file_cid,))
+    file_keys = HelperFuncs.get_file_keys(file_cid)
 
-            found_file = cursor.fetchone()
+    if file_keys is None:
+        abort(404)
 
-            if found_file:
-                filename, secret_key, file_cid = found_file[0], bytes(found_file[1]), found_file[2]
+    file_url = f'{connection_args.ipfs_api_url}/ipfs/{file_cid}'
 
-                file_url = f'{connection_args.ipfs_api_url}/ipfs/{file_cid}'
+    if request.args.get('offset') is None:
+        return stream_file(file_url, file_keys)
 
-                offset = int(request.args.get('offset'))
-                chunk_size = int(request.args.get('chunk_size'))
-                offset_with_iv = offset + AES.block_size
+    offset = int(request.args.get('offset'))
+    chunk_size = int(request.args.get('chunk_size'))
 
-                headers_for_chunk = {'Range': f'bytes={offset_with_iv}-{offset_with_iv + chunk_size - 1}'}
-                headers_for_iv = {'Range': 'bytes=0-15'}
+    app.logger.info(f'Requested offset: {offset} and chunk_size: {chunk_size} for {file_cid}')
 
-                try:
-                    response_get_iv = requests.get(file_url,
-                                                   headers=headers_for_iv,
-                                                   timeout=2)
-                    response_get_chunk = requests.get(file_url,
-                                                      headers=headers_for_chunk,
-                                                      timeout=2)
-                except (Exception,) as e:
-                    abort(404)
+    # Доступ уже проверен через get_file_keys, поэтому результат можно разделить между пользователями
+    required_chunk = chunk_requests.do((file_url, offset, chunk_size),
+                                       lambda: fetch_chunk(file_url, file_keys, offset, chunk_size))
 
-                os.makedirs('temp/', exist_ok=True)
+    if required_chunk is None:
+        abort(404)
 
-                app.logger.info(f'Requested offset: {offset} and chunk_size: {chunk_size} for {filename}')
+    return required_chunk
 
-                iv = response_get_iv.content
-                chunk = response_get_chunk.content
 
-                required_chunk = security_utils.decrypt_certain_chunk(secret_key,
-                                                                      iv,
-                                                                      offset,
-                                                                      chunk)
+def fetch_chunk(file_url: str, file_keys: FileKeys, offset: int, chunk_size: int) -> Optional[bytes]:
+    try:
+        return fetch_range(file_url, file_keys, offset, offset + chunk_size)
+    except (Exception,) as e:
+        app.logger.error(f'Can"t get chunk {offset}:{chunk_size} of {file_url}: {e}')
 
-                return required_chunk
+        return None
 
-            else:
-                abort(404)
+
+def fetch_range(file_url: str, file_keys: FileKeys, start: int, stop: int, timeout=None) -> bytes:
+    # decrypt_certain_chunk работает только с начала блока AES, поэтому запрашиваем от выровненного смещения
+    aligned_start = start - start % AES.block_size
+
+    # Первые AES.block_size байт объекта в IPFS занимает IV
+    headers_for_range = {'Range': f'bytes={aligned_start + AES.block_size}-{stop + AES.block_size - 1}'}
+
+    if timeout is None:
+        response_get_range = ipfs_utils.get(file_url, headers=headers_for_range)
+    else:
+        response_get_range = ipfs_utils.get(file_url, headers=headers_for_range, timeout=timeout)
+
+    # Без 206 шлюз вернул объект целиком, а не запрошенный диапазон
+    if response_get_range.status_code != 206:
+        raise Exception(response_get_range.status_code)
+
+    decrypted_range = security_utils.decrypt_certain_chunk(file_keys.secret_key,
+                                                           file_keys.iv,
+                                                           aligned_start,
+                                                           response_get_range.content)
+
+    return decrypted_range[start - aligned_start:]
+
+
+def stream_file(file_url: str, file_keys: FileKeys) -> Response:
+    file_size = file_keys.file_size
+
+    if request.range is None:
+        start, stop, status = 0, file_size, 200
+    else:
+        file_range = request.range.range_for_length(file_size)
+
+        if file_range is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{file_size}'})
+
+        (start, stop), status = file_range, 206
+
+    headers = {'Accept-Ranges': 'bytes',
+               'Content-Length': str(stop - start)}
+
+    if status == 206:
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{file_size}'
+
+    if start == stop:
+        return Response(b'', status=status, headers=headers, mimetype='application/octet-stream')
+
+    if stop - start > app.config['STREAM_PART_SIZE']:
+        return stream_file_parts(file_url, file_keys, start, stop, status, headers)
+
+    try:
+        # Первые AES.block_size байт объекта в IPFS занимает IV
+        response_get_file = ipfs_utils.get(file_url,
+                                           headers={'Range': f'bytes={start + AES.block_size}-'
+                                                             f'{stop + AES.block_size - 1}'},
+                                           stream=True,
+                                           timeout=app.config['STREAM_TIMEOUT'])
+
+        # 200 значит, что шлюз проигнорировал Range и отдает объект с IV с начала: расшифровка дала бы мусор
+        if response_get_file.status_code != 206:
+            response_get_file.close()
+
+            raise Exception(response_get_file.status_code)
+    except (Exception,) as e:
+        app.logger.error(f'Can"t stream {file_url}: {e}')
+
+        abort(404)
+
+    def _generate_file_content():
+        with response_get_file:
+            yield from security_utils.decrypt_stream(file_keys.secret_key,
+                                                     file_keys.iv,
+                                                     start,
+                                                     response_get_file.iter_content(app.config['STREAM_CHUNK_SIZE']))
+
+    return Response(_generate_file_content(), status=status, headers=headers, mimetype='application/octet-stream')
+
+
+def stream_file_parts(file_url: str, file_keys: FileKeys, start: int, stop: int,
+                      status: int, headers: dict) -> Response:
+    part_size = app.config['STREAM_PART_SIZE']
+
+    # Границы частей кратны part_size, первая часть может начинаться с произвольного смещения
+    part_ranges = iter([(part_start, min(part_start - part_start % part_size + part_size, stop))
+                        for part_start in [start] + list(range(start - start % part_size + part_size,
+                                                                  stop,
+                                                                  part_size))])
+
+    def _submit_next_part(pending_parts: collections.deque) -> None:
+        part_range = next(part_ranges, None)
+
+        if part_range is not None:
+            pending_parts.append(range_fetch_pool.submit(fetch_range, file_url, file_keys, *part_range,
+                                                         timeout=(ipfs_utils.CONNECT_TIMEOUT,
+                                                                  app.config['STREAM_TIMEOUT'])))
+
+    # Задержка до шлюза IPFS ограничивает скорость одного запроса, поэтому части загружаются параллельно
+    pending_parts = collections.deque()
+
+    for _ in range(app.config['STREAM_PARALLEL_PARTS']):
+        _submit_next_part(pending_parts)
+
+    try:
+        first_part = pending_parts[0].result()
+    except (Exception,) as e:
+        app.logger.error(f'Can"t stream {file_url}: {e}')
+
+        for part in pending_parts:
+            part.cancel()
+
+        abort(404)
+
+    def _generate_file_content():
+        try:
+            pending_parts.popleft()
+            _submit_next_part(pending_parts)
+
+            yield first_part
+
+            while pending_parts:
+                part = pending_parts.popleft().result()
+
+                _submit_next_part(pending_parts)
+
+                yield part
+        finally:
+            for pending_part in pending_parts:
+                pending_part.cancel()
+
+    return Response(_generate_file_content(), status=status, headers=headers, mimetype='application/octet-stream')
 
 
 @app.route('/fuse/info/')
@@ -422,29 +777,15 @@ def fuse_get_file():
 
     path_parts = file_path[1:].split('/')
 
-    def _make_default_dict_for_folder(directory_id: Optional[int] = None):
-        return {
-            'st': {
-                'st_mode': stat.S_IFDIR | 0o755,
-                'st_nlink': 2,
-                'sn_size': 4096,
-                'st_ctime': time(),  # Время создания
-                'st_mtime': time(),  # Время последнего изменения
-                'st_atime': time(),  # Время последнего доступа
-            },
-            'cid': None,
-            'id': directory_id
-        }
-
     app.logger.info(path_parts)
 
     if file_path == '/':
-        return _make_default_dict_for_folder()
+        return HelperFuncs.make_directory_info()
     elif len(path_parts) == 1:
         roles = HelperFuncs.get_user_roles()
 
         if path_parts[0] in roles:
-            return _make_default_dict_for_folder()
+            return HelperFuncs.make_directory_info()
         else:
             return 'Only roles is allowed by /', 404
     else:
@@ -458,22 +799,49 @@ def fuse_get_file():
             file_info = HelperFuncs.get_file_info_by_name(role, file_name, search_directory_id)
 
             if file_info['is_dir']:
-                return _make_default_dict_for_folder(file_info['id'])
+                return HelperFuncs.make_directory_info(file_info['id'])
         except (FileNotFoundError,):
             return '', 404
 
-        return {
-            'st': {
-                'st_mode': stat.S_IFREG | 0o644,
-                'st_nlink': 0,
-                'st_size': file_info['size'],
-                'st_ctime': time(),  # Время создания
-                'st_mtime': time(),  # Время последнего изменения
-                'st_atime': time(),  # Время последнего доступа
-            },
-            'cid': file_info['cid'],
-            'id': None,
-        }
+        return HelperFuncs.make_file_info(file_info['size'], file_info['cid'])
+
+
+@app.route('/fuse/resolve')
+@auth_decorators.auth_required
+def fuse_resolve_path():
+    file_path = request.args.get('path')
+
+    path_parts = file_path[1:].split('/')
+
+    if file_path == '/':
+        return {**HelperFuncs.make_directory_info(), 'ancestors': []}
+
+    if len(path_parts) == 1:
+        if path_parts[0] not in HelperFuncs.get_user_roles():
+            return 'Only roles is allowed by /', 404
+
+        return {**HelperFuncs.make_directory_info(), 'ancestors': []}
+
+    role = path_parts[0]
+
+    fresh_etag = HelperFuncs.get_fresh_etag(role)
+
+    if fresh_etag is not None:
+        response = make_response('', 304)
+        response.set_etag(fresh_etag)
+
+        return response
+
+    # Представления registry и directories уже ограничены ролями пользователя, отдельная проверка не нужна
+    try:
+        file_info, etag = HelperFuncs.resolve_path(role, path_parts[1:])
+    except (FileNotFoundError,):
+        return '', 404
+
+    response = make_response(file_info)
+    response.set_etag(etag)
+
+    return response
 
 
 @app.route('/fuse/dir/read/', defaults={'dir_name': None})
@@ -498,6 +866,136 @@ def fuse_read_dir():
         return HelperFuncs.get_files_in_directory(role, directory_id)
 
 
+@app.route('/fuse/dir/read/plus')
+@auth_decorators.auth_required
+def fuse_read_dir_plus():
+    dir_path = request.form.get('path')
+
+    if dir_path == '/':
+        return [{'name': role, **HelperFuncs.make_directory_info()} for role in HelperFuncs.get_user_roles()]
+
+    dir_path_parts = dir_path[1:].split('/')
+
+    role = dir_path_parts[0]
+    directory_id = int(request.form.get('directory_id')) if len(dir_path_parts) > 1 else None
+
+    fresh_etag = HelperFuncs.get_fresh_etag(role, directory_id or 0)
+
+    if fresh_etag is not None:
+        response = make_response('', 304)
+        response.set_etag(fresh_etag)
+
+        return response
+
+    # Версии читаются до содержимого: при гонке клиент получит устаревший ETag и просто перезапросит папку
+    etag = HelperFuncs.make_etag(role, HelperFuncs.get_directory_chain(role, directory_id))
+
+    response = make_response(HelperFuncs.get_directory_entries(role, directory_id))
+    response.set_etag(etag)
+
+    return response
+
+
+@app.route('/fuse/snapshot')
+@auth_decorators.auth_required
+def fuse_snapshot():
+    connection_args = auth_utils.get_connection_args()
+
+    role = request.args.get('role')
+
+    if role not in HelperFuncs.get_user_roles():
+        return '', 404
+
+    def _generate_entries():
+        with db_utils.get_connection(connection_args) as connection:
+            # Именованный курсор читает результат с сервера порциями, а не целиком в память
+            with connection.cursor(name='fuse_snapshot') as cursor:
+                cursor.itersize = app.config['SNAPSHOT_FETCH_SIZE']
+
+                # Все дерево роли одним запросом, чтобы папки, файлы и версии были из одного снимка.
+                # Корень роли идет первым, затем папки, затем файлы
+                cursor.execute('select 0 as kind, 0::bigint, null::bigint, null::varchar, null::bigint, null::varchar, '
+                               '       coalesce((select version from user_directory_versions '
+                               '                 where role=%(role)s and directory_id=0), 0) '
+                               'union all '
+                               'select 1, dd.id, dd.parent_directory, dd.name, null, null, '
+                               '       coalesce(versions.version, 0) from directories as dd '
+                               'left join user_directory_versions as versions '
+                               'on versions.role=dd.role and versions.directory_id=dd.id '
+                               'where dd.role=%(role)s '
+                               'union all '
+                               'select 2, null, directory, name, file_size, cid, null from registry_latest '
+                               'where role=%(role)s '
+                               'order by kind',
+                               {'role': role})
+
+                for kind, directory_id, parent_directory, name, file_size, cid, version in cursor:
+                    if kind == 0:
+                        entry = ['r', version]
+                    elif kind == 1:
+                        entry = ['d', directory_id, parent_directory, name, version]
+                    else:
+                        entry = ['f', parent_directory, name, file_size, cid]
+
+                    yield json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    return Response(_generate_entries(), mimetype='application/x-ndjson')
+
+
+@app.route('/fuse/changes')
+@auth_decorators.auth_required
+def fuse_changes():
+    connection_args = auth_utils.get_connection_args()
+
+    roles = set(HelperFuncs.get_user_roles())
+
+    # LISTEN держит соединение все время подписки, поэтому оно открывается отдельно от пула
+    connection = db_utils.open_connection(connection_args)
+    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+    with connection.cursor() as cursor:
+        cursor.execute('listen moonstorage_changes')
+
+    def _generate_events():
+        nonlocal roles
+
+        try:
+            yield ': connected\n\n'
+
+            while True:
+                if select.select([connection], [], [], app.config['CHANGES_HEARTBEAT_INTERVAL']) == ([], [], []):
+                    # Комментарий SSE не дает прокси закрыть соединение и выявляет отключившихся клиентов
+                    yield ': heartbeat\n\n'
+
+                    continue
+
+                connection.poll()
+
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+
+                    change = json.loads(notify.payload)
+
+                    if change['kind'] == 'roles':
+                        # Назначения ролей изменились: кэши сбрасывает roles_listener, клиент перечитывает дерево
+                        roles = set(HelperFuncs.load_user_roles(connection_args))
+
+                        yield f'data: {notify.payload}\n\n'
+                    elif change['role'] in roles:
+                        yield f'data: {notify.payload}\n\n'
+        finally:
+            connection.close()
+
+    response = Response(_generate_events(),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+    response.call_on_close(connection.close)
+
+    return response
+
+
 @app.route('/fuse/file/exists')
 @auth_decorators.auth_required
 def fuse_check_file_exists():
@@ -512,18 +1010,14 @@ def fuse_check_file_exists():
 
     connection_args = auth_utils.get_connection_args()
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
+    with db_utils.get_connection(connection_args) as connection:
         with connection.cursor() as cursor:
             if not directory_id:
-                cursor.execute("select file_size from registry "
+                cursor.execute("select file_size from registry_latest "
                                "where role=%s and name=%s and directory is null",
                                (path_parts[0], path_parts[-1]))
             else:
-                cursor.execute("select file_size from registry "
+                cursor.execute("select file_size from registry_latest "
                                "where role=%s and name=%s and directory=%s",
                                (path_parts[0], path_parts[-1], directory_id))
 
@@ -535,6 +1029,33 @@ def fuse_check_file_exists():
                 return {'exists': True, 'size': found_file[0]}
 
 
+@app.route('/fuse/file/grant/<file_cid>')
+@auth_decorators.auth_required
+def fuse_file_grant(file_cid: str):
+    # Ключ отдается только для одного файла и только пользователю, которому файл доступен по ролям.
+    # Сам ключ отозвать нельзя, поэтому клиент обязан перезапрашивать грант по истечении срока
+    if not app.config['FILE_GRANTS_ENABLED']:
+        abort(403)
+
+    connection_args = auth_utils.get_connection_args()
+
+    file_keys = HelperFuncs.get_file_keys(file_cid)
+
+    if file_keys is None:
+        abort(404)
+
+    response = make_response({'cid': file_cid,
+                              'secret_key': base64.b64encode(file_keys.secret_key).decode('ascii'),
+                              'iv': base64.b64encode(file_keys.iv).decode('ascii'),
+                              'file_size': file_keys.file_size,
+                              'gateway_url': connection_args.ipfs_api_url,
+                              'expires_in': app.config['FILE_GRANT_TTL']})
+
+    response.headers['Cache-Control'] = 'no-store'
+
+    return response
+
+
 @app.route('/delete', methods=['POST'])
 @auth_decorators.auth_required
 def remove_file():
@@ -546,11 +1067,7 @@ def remove_file():
 
     directory_id = request.form.get('directory_id')
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
+    with db_utils.get_connection(connection_args) as connection:
         with connection.cursor() as cursor:
             if directory_id:
                 cursor.execute('delete from registry '
@@ -573,11 +1090,7 @@ def create_dir():
 
     role, directory_path_parts = path_parts[0], path_parts[1]
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
+    with db_utils.get_connection(connection_args) as connection:
         with connection.cursor() as cursor:
             if len(path_parts) == 1:
                 cursor.execute('insert into directories_data(role, name) values(%s, %s)',
@@ -601,11 +1114,7 @@ def rename_dir():
     new_name = request.form.get('new').split('/')[-1]
     directory_id = request.form.get('directory_id')
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
+    with db_utils.get_connection(connection_args) as connection:
         with connection.cursor() as cursor:
             cursor.execute('update directories set name=%s where id=%s',
                            (new_name, directory_id))
@@ -625,11 +1134,7 @@ def move():
     from_id = request.args.get('from_id')
     to_id = request.args.get('to_id')
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
+    with db_utils.get_connection(connection_args) as connection:
         with connection.cursor() as cursor:
             app.logger.info(f'Move file {filename} from {from_id} to {to_id} in role {role}')
 
@@ -657,11 +1162,7 @@ def rename_file():
 
     directory_id = request.args.get('directory_id')
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
+    with db_utils.get_connection(connection_args) as connection:
         with connection.cursor() as cursor:
             if directory_id:
                 cursor.execute('update registry set name=%s '
@@ -682,11 +1183,7 @@ def rm_dir():
 
     directory_id = request.form.get('directory_id')
 
-    with psycopg2.connect(dbname='ipfs',
-                          user=connection_args.username,
-                          password=connection_args.password,
-                          host=connection_args.db_host,
-                          port=connection_args.db_port) as connection:
+    with db_utils.get_connection(connection_args) as connection:
         with connection.cursor() as cursor:
             cursor.execute('delete from directories where id=%s',
                            (directory_id,))
@@ -0,0 +1,467 @@
+import asyncio
+import collections
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from typing import Callable, Optional
+
+import aiohttp
+import psycopg2
+from aiohttp import web
+from Crypto.Cipher import AES
+from werkzeug.http import parse_range_header
+
+from helper_classes import ConnectionArgs, FileKeys
+
+from utils import auth_utils, security_utils, db_utils, cache_utils, upload_utils, notify_utils
+
+# Асинхронная реализация /download и /upload: обработчики почти все время ждут шлюз или RPC IPFS,
+# поэтому один процесс держит тысячи таких запросов. Остальные эндпоинты остаются в api.py.
+# Запуск: MS_API_WORKER_CLASS=aiohttp.GunicornWebWorker MS_API_BIND=0.0.0.0:5051 \
+#         gunicorn -c gunicorn_config.py async_api:app
+
+GATEWAY_CONNECTIONS = 2000
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 10
+UPLOAD_READ_TIMEOUT = 300
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_PART_SIZE = 4 * 1024 * 1024
+STREAM_PARALLEL_PARTS = 4
+FILE_KEYS_CACHE_SIZE = 10000
+# Как и в api.py: ключ выдан по ролям пользователя и не должен пережить их изменение
+FILE_KEYS_CACHE_TTL = 60
+
+# Поля формы загрузки, кроме файла, читаются в память: role и directory_id короткие
+UPLOAD_FORM_FIELDS = ('role', 'directory_id')
+MAX_FORM_FIELD_SIZE = 1024
+
+# psycopg2 блокирующий, запросы к базе выполняются в пуле потоков
+DB_WORKERS = 16
+
+CLIENT_SESSION = web.AppKey('client_session', aiohttp.ClientSession)
+
+file_keys_cache = cache_utils.LRUCache(FILE_KEYS_CACHE_SIZE, FILE_KEYS_CACHE_TTL)
+file_keys_requests = cache_utils.AsyncSingleFlight()
+
+# Как и в api.py: ключи выданы по ролям и сбрасываются при изменении roles_mapping
+roles_listener = notify_utils.RolesChangeListener(file_keys_cache.clear)
+chunk_requests = cache_utils.AsyncSingleFlight()
+
+db_pool = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+def auth_required(func: Callable) -> Callable:
+    @wraps(func)
+    async def wrapper(request: web.Request) -> web.StreamResponse:
+        connection_args = auth_utils.get_connection_args_from_token(request.cookies.get('token'))
+
+        if connection_args is None:
+            raise web.HTTPForbidden()
+
+        request['connection_args'] = connection_args
+
+        return await func(request)
+
+    return wrapper
+
+
+async def run_in_db_pool(func: Callable, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_pool, func, *args)
+
+
+def get_secret_key(file_cid: str, connection_args: ConnectionArgs) -> Optional[tuple[bytes, int]]:
+    with db_utils.get_connection(connection_args) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute('select secret_key, file_size from registry '
+                           'where cid=%s '
+                           'order by uploaded_at desc', (file_cid,))
+
+            found_file = cursor.fetchone()
+
+    if not found_file:
+        return None
+
+    return bytes(found_file[0]), found_file[1]
+
+
+async def fetch_range(session: aiohttp.ClientSession, file_url: str, start: int, stop: int) -> bytes:
+    # Первые AES.block_size байт объекта в IPFS занимает IV
+    async with session.get(file_url,
+                           headers={'Range': f'bytes={start + AES.block_size}-{stop + AES.block_size - 1}'},
+                           timeout=aiohttp.ClientTimeout(connect=CONNECT_TIMEOUT,
+                                                         sock_read=READ_TIMEOUT)) as response:
+        # Без 206 шлюз проигнорировал Range и вернул объект целиком вместе с IV
+        if response.status != 206:
+            raise Exception(response.status)
+
+        return await response.read()
+
+
+async def fetch_iv(session: aiohttp.ClientSession, file_url: str) -> Optional[bytes]:
+    async with session.get(file_url,
+                           headers={'Range': f'bytes=0-{AES.block_size - 1}'},
+                           timeout=aiohttp.ClientTimeout(connect=CONNECT_TIMEOUT,
+                                                         sock_read=READ_TIMEOUT)) as response:
+        iv = await response.read()
+
+    if len(iv) != AES.block_size:
+        return None
+
+    return iv
+
+
+async def get_file_keys(session: aiohttp.ClientSession,
+                        file_cid: str,
+                        connection_args: ConnectionArgs) -> Optional[FileKeys]:
+    # Доступ к файлу определяется ролями пользователя, поэтому ключ кэша включает его учетные данные
+    cache_key = (file_cid, connection_args)
+
+    roles_listener.ensure_started(connection_args)
+
+    file_keys = file_keys_cache.get(cache_key)
+
+    if file_keys is not None:
+        return file_keys
+
+    return await file_keys_requests.do(cache_key, lambda: load_file_keys(session, file_cid, connection_args))
+
+
+async def load_file_keys(session: aiohttp.ClientSession,
+                         file_cid: str,
+                         connection_args: ConnectionArgs) -> Optional[FileKeys]:
+    # Ключ из базы и IV из шлюза запрашиваются одновременно
+    found_file, iv = await asyncio.gather(run_in_db_pool(get_secret_key, file_cid, connection_args),
+                                          fetch_iv(session, f'{connection_args.ipfs_api_url}/ipfs/{file_cid}'),
+                                          return_exceptions=True)
+
+    if isinstance(found_file, BaseException):
+        raise found_file
+
+    if not found_file or isinstance(iv, BaseException) or iv is None:
+        return None
+
+    secret_key, file_size = found_file
+
+    file_keys = FileKeys(secret_key=secret_key,
+                         iv=iv,
+                         file_size=file_size)
+
+    file_keys_cache.set((file_cid, connection_args), file_keys)
+
+    return file_keys
+
+
+@auth_required
+async def get_file(request: web.Request) -> web.StreamResponse:
+    connection_args = request['connection_args']
+    session = request.app[CLIENT_SESSION]
+
+    file_cid = request.match_info['file_cid']
+    file_url = f'{connection_args.ipfs_api_url}/ipfs/{file_cid}'
+
+    if request.query.get('offset') is None:
+        return await stream_file(request, session, file_url, file_cid, connection_args)
+
+    offset = int(request.query['offset'])
+    chunk_size = int(request.query['chunk_size'])
+
+    # decrypt_certain_chunk работает только с начала блока AES
+    aligned_offset = offset - offset % AES.block_size
+
+    # Ключи и фрагмент запрашиваются одновременно, но фрагмент отдается только после проверки доступа.
+    # Шифротекст одинаков для всех пользователей, поэтому одновременные запросы одного фрагмента объединяются
+    file_keys, chunk = await asyncio.gather(get_file_keys(session, file_cid, connection_args),
+                                            chunk_requests.do((file_url, offset, chunk_size),
+                                                              lambda: fetch_range(session, file_url, aligned_offset,
+                                                                                  offset + chunk_size)),
+                                            return_exceptions=True)
+
+    if isinstance(file_keys, BaseException) or file_keys is None or isinstance(chunk, BaseException):
+        raise web.HTTPNotFound()
+
+    required_chunk = security_utils.decrypt_certain_chunk(file_keys.secret_key,
+                                                          file_keys.iv,
+                                                          aligned_offset,
+                                                          chunk)
+
+    return web.Response(body=required_chunk[offset - aligned_offset:], content_type='application/octet-stream')
+
+
+async def stream_file(request: web.Request,
+                      session: aiohttp.ClientSession,
+                      file_url: str,
+                      file_cid: str,
+                      connection_args: ConnectionArgs) -> web.StreamResponse:
+    file_keys = await get_file_keys(session, file_cid, connection_args)
+
+    if file_keys is None:
+        raise web.HTTPNotFound()
+
+    file_size = file_keys.file_size
+
+    # Разбор Range совпадает с api.stream_file: некорректный заголовок игнорируется
+    request_range = parse_range_header(request.headers.get('Range'))
+
+    if request_range is None:
+        start, stop, status = 0, file_size, 200
+    else:
+        file_range = request_range.range_for_length(file_size)
+
+        if file_range is None:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{file_size}'})
+
+        (start, stop), status = file_range, 206
+
+    headers = {'Accept-Ranges': 'bytes',
+               'Content-Length': str(stop - start),
+               'Content-Type': 'application/octet-stream'}
+
+    if status == 206:
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{file_size}'
+
+    if start == stop:
+        return web.Response(status=status, headers=headers)
+
+    if stop - start > STREAM_PART_SIZE:
+        return await stream_file_parts(request, session, file_url, file_keys, start, stop, status, headers)
+
+    try:
+        gateway_response = await session.get(file_url,
+                                             headers={'Range': f'bytes={start + AES.block_size}-'
+                                                               f'{stop + AES.block_size - 1}'},
+                                             timeout=aiohttp.ClientTimeout(connect=CONNECT_TIMEOUT,
+                                                                           sock_read=READ_TIMEOUT))
+
+        if gateway_response.status != 206:
+            gateway_response.release()
+
+            raise Exception(gateway_response.status)
+    except (Exception,) as e:
+        logging.error(f'Can"t stream {file_url}: {e}')
+
+        raise web.HTTPNotFound()
+
+    async with gateway_response:
+        response = web.StreamResponse(status=status, headers=headers)
+
+        await response.prepare(request)
+
+        decipher = security_utils.get_ctr_cipher(file_keys.secret_key, file_keys.iv, start)
+
+        async for chunk in gateway_response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            await response.write(decipher.decrypt(chunk))
+
+        await response.write_eof()
+
+    return response
+
+
+async def fetch_part(session: aiohttp.ClientSession, file_url: str, file_keys: FileKeys,
+                     start: int, stop: int) -> bytes:
+    ciphertext = await fetch_range(session, file_url, start, stop)
+
+    return security_utils.get_ctr_cipher(file_keys.secret_key, file_keys.iv, start).decrypt(ciphertext)
+
+
+async def stream_file_parts(request: web.Request,
+                            session: aiohttp.ClientSession,
+                            file_url: str,
+                            file_keys: FileKeys,
+                            start: int,
+                            stop: int,
+                            status: int,
+                            headers: dict) -> web.StreamResponse:
+    # Границы частей кратны STREAM_PART_SIZE, первая часть может начинаться с произвольного смещения
+    part_ranges = iter([(part_start, min(part_start - part_start % STREAM_PART_SIZE + STREAM_PART_SIZE, stop))
+                        for part_start in [start] + list(range(start - start % STREAM_PART_SIZE + STREAM_PART_SIZE,
+                                                                  stop,
+                                                                  STREAM_PART_SIZE))])
+
+    def _submit_next_part() -> None:
+        part_range = next(part_ranges, None)
+
+        if part_range is not None:
+            pending_parts.append(asyncio.ensure_future(fetch_part(session, file_url, file_keys, *part_range)))
+
+    # Как и в api.stream_file_parts: скорость одного запроса ограничена задержкой до шлюза, части идут параллельно
+    pending_parts = collections.deque()
+
+    for _ in range(STREAM_PARALLEL_PARTS):
+        _submit_next_part()
+
+    try:
+        try:
+            # Ошибку первой части еще можно вернуть статусом ответа
+            await pending_parts[0]
+        except (Exception,) as e:
+            logging.error(f'Can"t stream {file_url}: {e}')
+
+            raise web.HTTPNotFound()
+
+        response = web.StreamResponse(status=status, headers=headers)
+
+        await response.prepare(request)
+
+        while pending_parts:
+            part = await pending_parts.popleft()
+
+            _submit_next_part()
+
+            await response.write(part)
+    finally:
+        for pending_part in pending_parts:
+            pending_part.cancel()
+
+    await response.write_eof()
+
+    return response
+
+
+def has_role(connection_args: ConnectionArgs, role: str) -> bool:
+    with db_utils.get_connection(connection_args) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute('select 1 from public.user_roles where role=%s', (role,))
+
+            return cursor.fetchone() is not None
+
+
+async def read_form_field(part: aiohttp.BodyPartReader) -> str:
+    # part.text() читает часть целиком и не ограничена client_max_size при потоковом чтении multipart
+    value = bytearray()
+
+    while chunk := await part.read_chunk(MAX_FORM_FIELD_SIZE):
+        value += chunk
+
+        if len(value) > MAX_FORM_FIELD_SIZE:
+            raise Exception(f'Поле {part.name} слишком длинное!')
+
+    return value.decode(part.get_charset(default='utf-8'))
+
+
+def insert_file(connection_args: ConnectionArgs, uploaded_file_cid: str, uploaded_filename: str,
+                secret_key: bytes, required_role: str, uploaded_file_size: int, file_hash: str,
+                directory_id: Optional[str]) -> None:
+    with db_utils.get_connection(connection_args) as connection:
+        with connection.cursor() as cursor:
+            if directory_id:
+                cursor.execute("insert into registry_data(cid, name, secret_key, role, file_size, file_hash, "
+                               "directory)"
+                               "values(%s, %s, %s, %s, %s, %s, %s)",
+                               (uploaded_file_cid, uploaded_filename, psycopg2.Binary(secret_key), required_role,
+                                uploaded_file_size, file_hash, directory_id))
+            else:
+                cursor.execute("insert into registry_data(cid, name, secret_key, role, file_size, file_hash) "
+                               "values(%s, %s, %s, %s, %s, %s)",
+                               (uploaded_file_cid, uploaded_filename, psycopg2.Binary(secret_key), required_role,
+                                uploaded_file_size, file_hash))
+
+
+@auth_required
+async def upload_file(request: web.Request) -> web.StreamResponse:
+    connection_args = request['connection_args']
+    session = request.app[CLIENT_SESSION]
+
+    try:
+        fields = dict()
+        uploaded = None
+
+        reader = await request.multipart()
+
+        # Поля формы должны идти до файла: они проверяются до того, как файл попадет в IPFS.
+        # Так отправляют и ms_cli (requests кладет data перед files), и клиент FUSE
+        async for part in reader:
+            if part.name != 'file':
+                if part.name in UPLOAD_FORM_FIELDS:
+                    fields[part.name] = await read_form_field(part)
+
+                continue
+
+            if uploaded is not None or not part.filename:
+                raise Exception('Неправильное имя файла!')
+
+            required_role = fields.get('role')
+
+            if not required_role:
+                raise Exception('Укажите роль, с которой добавляете файл!')
+
+            if fields.get('directory_id') and not fields['directory_id'].isdigit():
+                raise Exception('Неправильный id папки!')
+
+            if not await run_in_db_pool(has_role, connection_args, required_role):
+                raise Exception(f'Нет доступа к роли {required_role}!')
+
+            secret_key = security_utils.get_random_aes_key()
+
+            async def _read_file_part(file_part=part):
+                while chunk := await file_part.read_chunk(upload_utils.BUF_SIZE):
+                    yield chunk
+
+            upload = upload_utils.AsyncEncryptedUpload(_read_file_part(), secret_key)
+
+            # Файл шифруется и передается в IPFS по мере чтения тела запроса
+            async with session.post(f'{connection_args.ipfs_rpc_url}/api/v0/add',
+                                    data=upload.multipart_body(),
+                                    headers={'Content-Type': upload.content_type},
+                                    timeout=aiohttp.ClientTimeout(connect=CONNECT_TIMEOUT,
+                                                                  sock_read=UPLOAD_READ_TIMEOUT)) as response:
+                ipfs_response = await response.json(content_type=None)
+
+            uploaded = (part.filename, secret_key, upload, ipfs_response['Hash'])
+
+        if uploaded is None:
+            raise Exception('Файл отсутствует!')
+
+        uploaded_filename, secret_key, upload, uploaded_file_cid = uploaded
+
+        logging.info(f'Uploaded a new file {uploaded_filename} with role {required_role}...')
+
+        await run_in_db_pool(insert_file, connection_args, uploaded_file_cid, uploaded_filename, secret_key,
+                             required_role, upload.file_size, upload.file_hash, fields.get('directory_id'))
+    except (Exception,) as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    return web.Response(body=json.dumps({'cid': uploaded_file_cid,
+                                         'size': upload.file_size,
+                                         'hash': upload.file_hash}, indent=4, ensure_ascii=False).encode('utf-8'))
+
+
+async def check_health(request: web.Request) -> web.StreamResponse:
+    return web.Response(text='alive')
+
+
+async def client_session_context(app: web.Application):
+    # Лимит соединений ограничивает число одновременных запросов к IPFS на процесс
+    connector = aiohttp.TCPConnector(limit=GATEWAY_CONNECTIONS, limit_per_host=GATEWAY_CONNECTIONS)
+
+    app[CLIENT_SESSION] = aiohttp.ClientSession(connector=connector)
+
+    yield
+
+    await app[CLIENT_SESSION].close()
+
+
+def make_app() -> web.Application:
+    # Тело загрузки читается потоком, поэтому client_max_size его не ограничивает: размер полей формы
+    # проверяет read_form_field, общий размер тела - nginx
+    async_app = web.Application()
+
+    async_app.cleanup_ctx.append(client_session_context)
+
+    async_app.add_routes([web.get('/download/{file_cid}', get_file),
+                          web.post('/upload', upload_file),
+                          web.get('/health', check_health)])
+
+    return async_app
+
+
+app = make_app()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s | %(levelname)s]: %(message)s',
+                        datefmt='%m.%d.%Y %H:%M:%S',
+                        level=logging.DEBUG)
+
+    web.run_app(app, host='0.0.0.0', port=5051)
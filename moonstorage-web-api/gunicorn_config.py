@@ -0,0 +1,64 @@
+# Конфигурация gunicorn для продакшена: gunicorn -c gunicorn_config.py wsgi:app
+#
+# Модель воркеров задается переменной MS_API_WORKER_CLASS:
+#   gthread (по умолчанию) - процессы с пулом потоков. Обработчик, ждущий шлюз IPFS, занимает один поток,
+#       а не весь процесс. Одновременно обслуживается workers * threads запросов.
+#       Каждая подписка /fuse/changes держит поток, поэтому threads должно быть больше числа смонтированных клиентов.
+#   sync - один запрос на процесс, как у app.run(). Подходит только для отладки:
+#       одна долгая загрузка блокирует весь воркер, а /fuse/changes занимает его целиком.
+#   gevent - тысячи одновременных запросов на процесс. psycopg2 переводится на неблокирующий режим
+#       через psycogreen (pip install gevent psycogreen), иначе запрос к Postgres остановит весь воркер.
+#   aiohttp.GunicornWebWorker - только для async_api:app, асинхронной реализации /download и /upload.
+#
+# Пропускную способность каждой модели можно измерить с помощью ms_api_benchmark.py из корня репозитория,
+# например: python ms_api_benchmark.py -user user_1 -password pass --endpoint download --cid <cid> --concurrency 64
+# Для загрузок, ограниченных задержкой до шлюза IPFS, пропускная способность sync растет только с числом процессов,
+# gthread - с workers * threads, gevent - до пределов пула соединений ipfs_utils и Postgres.
+#
+# Плавный перезапуск: kill -HUP <pid мастера> запускает новые воркеры и дожидается завершения старых
+# в пределах graceful_timeout. С preload_app код перечитывается только при полном перезапуске мастера.
+
+import multiprocessing
+import os
+import shutil
+
+bind = os.environ.get('MS_API_BIND', '0.0.0.0:5050')
+
+worker_class = os.environ.get('MS_API_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('MS_API_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('MS_API_THREADS', 32))
+worker_connections = int(os.environ.get('MS_API_WORKER_CONNECTIONS', 1000))
+
+# Приложение импортируется один раз в мастере, воркеры получают его через fork.
+# Пулы потоков, соединений с базой и HTTP-сессии создаются лениво, поэтому не делятся между процессами.
+# С gevent preload выключен: api.py создает блокировки, пулы потоков и сессию requests при импорте,
+# а monkey patching выполняется только в воркере, поэтому они остались бы непатченными
+preload_app = os.environ.get('MS_API_PRELOAD', '1') == '1' and worker_class != 'gevent'
+
+# nginx держит соединения с API открытыми (keepalive в nginx.conf), таймаут должен быть больше, чем у nginx
+keepalive = int(os.environ.get('MS_API_KEEPALIVE', 75))
+
+# Потоковые загрузки и подписка на изменения отвечают долго, но регулярно отправляют данные
+timeout = int(os.environ.get('MS_API_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('MS_API_GRACEFUL_TIMEOUT', 30))
+
+# Периодический перезапуск воркеров ограничивает рост памяти; jitter не дает им перезапуститься одновременно
+max_requests = int(os.environ.get('MS_API_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('MS_API_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('MS_API_LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+
+def on_exit(server):
+    from api import app
+
+    shutil.rmtree(app.config['UPLOAD_FOLDER'], ignore_errors=True)
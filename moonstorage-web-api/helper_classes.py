@@ -26,3 +26,9 @@ class ConnectionArgs(NamedTuple):
                               db_port=json_dict['db_port'],
                               ipfs_rpc_url=json_dict['ipfs_rpc_url'],
                               ipfs_api_url=json_dict['ipfs_api_url'])
+
+
+class FileKeys(NamedTuple):
+    secret_key: bytes
+    iv: bytes
+    file_size: int
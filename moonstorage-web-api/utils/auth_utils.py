@@ -1,11 +1,19 @@
+from time import time
 from typing import Type, Optional
 
 import jwt
 
-from flask import request, make_response
+from flask import request, make_response, g
 
 from helper_classes import ConnectionArgs
 
+from utils import cache_utils
+
+TOKEN_CACHE_SIZE = 4096
+
+# Токен -> (ConnectionArgs, exp или None): подпись HS256 проверяется один раз на токен, а не на каждый запрос
+token_cache = cache_utils.LRUCache(TOKEN_CACHE_SIZE)
+
 
 def make_token(connection_args: ConnectionArgs) -> str:
     encoded_jwt = jwt.encode({'connection_args': connection_args.to_json()},
@@ -20,14 +28,36 @@ def decode_token(encoded_jwt: str) -> dict:
 
 
 def get_connection_args() -> ConnectionArgs:
-    token = request.cookies.get('token')
+    # auth_required, обработчик и HelperFuncs получают аргументы из контекста запроса, токен разбирается один раз
+    if 'connection_args' not in g:
+        g.connection_args = get_connection_args_from_token(request.cookies.get('token'))
+
+    return g.connection_args
 
+
+def get_connection_args_from_token(token: Optional[str]) -> Optional[ConnectionArgs]:
     if token is None:
         return None
 
+    cached = token_cache.get(token)
+
+    if cached is not None:
+        connection_args, expires_at = cached
+
+        if expires_at is None or time() < expires_at:
+            return connection_args
+
+        token_cache.pop(token)
+
+        return None
+
     try:
         decoded_jwt = jwt.decode(token, "secret", algorithms=["HS256"])
-
-        return ConnectionArgs.from_json(decoded_jwt['connection_args'])
     except jwt.ExpiredSignatureError:
         return None
+
+    connection_args = ConnectionArgs.from_json(decoded_jwt['connection_args'])
+
+    token_cache.set(token, (connection_args, decoded_jwt.get('exp')))
+
+    return connection_args
@@ -0,0 +1,110 @@
+import asyncio
+import collections
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class LRUCache:
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.__max_size = max_size
+        self.__ttl = ttl
+        # Ключ -> (значение, момент устаревания по monotonic или None)
+        self.__items: collections.OrderedDict[Hashable, tuple[Any, Optional[float]]] = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            if key not in self.__items:
+                return None
+
+            value, until = self.__items[key]
+
+            if until is not None and monotonic() >= until:
+                del self.__items[key]
+
+                return None
+
+            self.__items.move_to_end(key)
+
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        # ttl записи заменяет ttl кэша, например когда значение устаревает раньше по данным из базы
+        ttl = self.__ttl if ttl is None else ttl
+
+        with self.__lock:
+            self.__items[key] = (value, None if ttl is None else monotonic() + ttl)
+            self.__items.move_to_end(key)
+
+            while len(self.__items) > self.__max_size:
+                self.__items.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            value, _ = self.__items.pop(key, (None, None))
+
+            return value
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__items.clear()
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__items)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.__calls: dict[Hashable, Future] = dict()
+        self.__lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        # Пока запрос по ключу выполняется, остальные вызовы ждут и получают его результат
+        with self.__lock:
+            call = self.__calls.get(key)
+            is_leader = call is None
+
+            if is_leader:
+                call = Future()
+                self.__calls[key] = call
+
+        if not is_leader:
+            return call.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            call.set_exception(e)
+
+            raise
+        else:
+            call.set_result(result)
+
+            return result
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__calls)
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self.__calls: dict[Hashable, asyncio.Task] = dict()
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        call = self.__calls.get(key)
+
+        if call is None:
+            call = asyncio.ensure_future(func())
+            self.__calls[key] = call
+
+            call.add_done_callback(lambda _call: self.__calls.pop(key, None))
+
+        # shield: отмена одного ожидающего запроса не должна отменять общий
+        return await asyncio.shield(call)
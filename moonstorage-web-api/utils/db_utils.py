@@ -0,0 +1,170 @@
+import contextlib
+import logging
+import threading
+from time import monotonic
+from typing import Iterator, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from helper_classes import ConnectionArgs
+
+from utils import auth_utils
+
+MAX_CONNECTIONS_PER_KEY = 10
+ACQUIRE_TIMEOUT = 5
+IDLE_TIMEOUT = 300
+HEALTH_CHECK_INTERVAL = 30
+
+
+def open_connection(connection_args: ConnectionArgs) -> psycopg2.extensions.connection:
+    return psycopg2.connect(dbname='ipfs',
+                            user=connection_args.username,
+                            password=connection_args.password,
+                            host=connection_args.db_host,
+                            port=connection_args.db_port)
+
+
+class ConnectionPool:
+    def __init__(self, connection_args: ConnectionArgs, max_size: int):
+        self.__connection_args = connection_args
+        self.__slots = threading.BoundedSemaphore(max_size)
+        self.__idle: list[tuple[psycopg2.extensions.connection, float]] = []
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> psycopg2.extensions.connection:
+        if not self.__slots.acquire(timeout=ACQUIRE_TIMEOUT):
+            raise Exception('Нет свободных подключений к базе данных!')
+
+        try:
+            while True:
+                with self.__lock:
+                    if not self.__idle:
+                        break
+
+                    connection, released_at = self.__idle.pop()
+
+                if self.__is_healthy(connection, released_at):
+                    return connection
+
+                self.__close(connection)
+
+            return open_connection(self.__connection_args)
+        except (Exception,):
+            self.__slots.release()
+
+            raise
+
+    def release(self, connection: psycopg2.extensions.connection, discard: bool = False) -> None:
+        try:
+            if discard or connection.closed \
+                    or connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self.__close(connection)
+            else:
+                with self.__lock:
+                    self.__idle.append((connection, monotonic()))
+        finally:
+            self.__slots.release()
+
+    def evict_idle(self) -> int:
+        now = monotonic()
+
+        with self.__lock:
+            expired = [connection for connection, released_at in self.__idle
+                       if now - released_at > IDLE_TIMEOUT]
+            self.__idle = [(connection, released_at) for connection, released_at in self.__idle
+                           if now - released_at <= IDLE_TIMEOUT]
+
+        for connection in expired:
+            self.__close(connection)
+
+        return len(expired)
+
+    @staticmethod
+    def __is_healthy(connection: psycopg2.extensions.connection, released_at: float) -> bool:
+        if connection.closed:
+            return False
+
+        idle_time = monotonic() - released_at
+
+        if idle_time > IDLE_TIMEOUT:
+            return False
+
+        if idle_time < HEALTH_CHECK_INTERVAL:
+            return True
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('select 1')
+
+            connection.rollback()
+        except (psycopg2.Error,):
+            return False
+
+        return True
+
+    @staticmethod
+    def __close(connection: psycopg2.extensions.connection) -> None:
+        try:
+            connection.close()
+        except (psycopg2.Error,):
+            pass
+
+
+class ConnectionPools:
+    def __init__(self, max_size_per_key: int):
+        self.__max_size_per_key = max_size_per_key
+        self.__pools: dict[ConnectionArgs, ConnectionPool] = dict()
+        self.__lock = threading.Lock()
+        self.__last_eviction = monotonic()
+
+    def get_pool(self, connection_args: ConnectionArgs) -> ConnectionPool:
+        with self.__lock:
+            if connection_args not in self.__pools:
+                self.__pools[connection_args] = ConnectionPool(connection_args, self.__max_size_per_key)
+
+            return self.__pools[connection_args]
+
+    def evict_idle(self) -> None:
+        with self.__lock:
+            if monotonic() - self.__last_eviction < HEALTH_CHECK_INTERVAL:
+                return
+
+            self.__last_eviction = monotonic()
+
+            pools = list(self.__pools.items())
+
+        for connection_args, pool in pools:
+            evicted = pool.evict_idle()
+
+            if evicted:
+                logging.debug(f'Closed {evicted} idle connections for {connection_args.username}')
+
+
+pools = ConnectionPools(MAX_CONNECTIONS_PER_KEY)
+
+
+@contextlib.contextmanager
+def get_connection(connection_args: Optional[ConnectionArgs] = None) -> Iterator[psycopg2.extensions.connection]:
+    if connection_args is None:
+        connection_args = auth_utils.get_connection_args()
+
+    pools.evict_idle()
+
+    pool = pools.get_pool(connection_args)
+    connection = pool.acquire()
+
+    try:
+        # Как и with psycopg2.connect(...): commit при успехе, rollback при исключении
+        with connection:
+            yield connection
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        pool.release(connection, discard=True)
+
+        raise
+    except BaseException:
+        pool.release(connection)
+
+        raise
+    else:
+        pool.release(connection)
@@ -0,0 +1,48 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOL_CONNECTIONS = 10
+POOL_MAX_SIZE = 100
+POOL_BLOCK = True
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.2
+RETRY_STATUS_FORCELIST = (502, 503, 504)
+
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 2
+UPLOAD_READ_TIMEOUT = 300
+
+
+def make_session() -> requests.Session:
+    # Повторяются только идемпотентные запросы: тело загрузки - генератор и не может быть отправлено повторно
+    retry = Retry(total=RETRY_TOTAL,
+                  backoff_factor=RETRY_BACKOFF_FACTOR,
+                  status_forcelist=RETRY_STATUS_FORCELIST,
+                  allowed_methods=frozenset({'GET', 'HEAD'}),
+                  raise_on_status=False)
+
+    # pool_connections - число хостов, pool_maxsize - число keep-alive соединений на хост
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                          pool_maxsize=POOL_MAX_SIZE,
+                          pool_block=POOL_BLOCK,
+                          max_retries=retry)
+
+    session = requests.Session()
+
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+session = make_session()
+
+
+def get(url: str, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs) -> requests.Response:
+    return session.get(url, timeout=timeout, **kwargs)
+
+
+def post(url: str, timeout=(CONNECT_TIMEOUT, UPLOAD_READ_TIMEOUT), **kwargs) -> requests.Response:
+    return session.post(url, timeout=timeout, **kwargs)
@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import select
+import threading
+from typing import Callable, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from helper_classes import ConnectionArgs
+
+from utils import db_utils
+
+CHANGES_CHANNEL = 'moonstorage_changes'
+POLL_INTERVAL = 30
+RETRY_INTERVAL = 5
+
+
+class RolesChangeListener:
+    # Каждый процесс API (воркеры gunicorn, async_api) держит свое соединение с LISTEN и по уведомлению
+    # об изменении roles_mapping вызывает on_change, чтобы сбросить кэши, зависящие от ролей.
+    # У API нет своей учетной записи в базе, поэтому подключение идет под последним пользователем,
+    # приславшим запрос: LISTEN доступен любому пользователю
+    def __init__(self, on_change: Callable[[], None]):
+        self.__on_change = on_change
+        self.__connection_args: Optional[ConnectionArgs] = None
+        self.__pid: Optional[int] = None
+        self.__lock = threading.Lock()
+
+    def ensure_started(self, connection_args: ConnectionArgs) -> None:
+        with self.__lock:
+            self.__connection_args = connection_args
+
+            # После fork поток родителя в дочернем процессе не существует
+            if self.__pid == os.getpid():
+                return
+
+            self.__pid = os.getpid()
+
+        threading.Thread(target=self.__listen, name='roles-listener', daemon=True).start()
+
+    def __listen(self) -> None:
+        while True:
+            with self.__lock:
+                connection_args = self.__connection_args
+
+            try:
+                connection = db_utils.open_connection(connection_args)
+            except (Exception,) as e:
+                logging.warning(f'Can"t listen for roles changes: {e}')
+
+                threading.Event().wait(RETRY_INTERVAL)
+
+                continue
+
+            try:
+                connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+                with connection.cursor() as cursor:
+                    cursor.execute(f'listen {CHANGES_CHANNEL}')
+
+                # Изменения, произошедшие без подписки, могли быть пропущены
+                self.__on_change()
+
+                while True:
+                    if select.select([connection], [], [], POLL_INTERVAL) == ([], [], []):
+                        # Проверяем, что соединение живо: иначе разрыв заметили бы только при следующем уведомлении
+                        with connection.cursor() as cursor:
+                            cursor.execute('select 1')
+
+                        continue
+
+                    connection.poll()
+
+                    is_roles_changed = False
+
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+
+                        if json.loads(notify.payload)['kind'] == 'roles':
+                            is_roles_changed = True
+
+                    if is_roles_changed:
+                        self.__on_change()
+            except (Exception,) as e:
+                logging.warning(f'Roles changes subscription lost: {e}')
+            finally:
+                connection.close()
+
+            threading.Event().wait(RETRY_INTERVAL)
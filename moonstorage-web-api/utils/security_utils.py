@@ -1,3 +1,5 @@
+from typing import Iterable, Iterator
+
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 from Crypto.Util import Counter
@@ -34,6 +36,22 @@ def encrypt_file(source_file_path: str,
                 encrypted_file.write(encrypted_chunk)
 
 
+def encrypt_stream(aes_key: bytes,
+                   chunks: Iterable[bytes]) -> Iterator[bytes]:
+    iv = get_random_bytes(AES.block_size)
+
+    initial_value = int.from_bytes(iv, byteorder='big')
+    counter = Counter.new(128, initial_value=initial_value)
+
+    cipher = AES.new(aes_key, AES.MODE_CTR, counter=counter)
+
+    # Формат совпадает с encrypt_file: IV, затем зашифрованное содержимое
+    yield iv
+
+    for chunk in chunks:
+        yield cipher.encrypt(chunk)
+
+
 def decrypt_file(source_file_path: str,
                  dst_file_path: str,
                  aes_key: bytes,
@@ -73,3 +91,30 @@ def decrypt_certain_chunk(aes_key: bytes,
     decrypted_chunk = decipher.decrypt(chunk)
 
     return decrypted_chunk
+
+
+def get_ctr_cipher(aes_key: bytes,
+                   iv: bytes,
+                   offset: int = 0):
+    initial_value = int.from_bytes(iv, byteorder='big')
+    block_index = offset // AES.block_size
+    counter = Counter.new(128, initial_value=initial_value + block_index)
+
+    cipher = AES.new(aes_key, AES.MODE_CTR, counter=counter)
+
+    # Смещение может быть не кратно размеру блока, пропускаем начало ключевого потока.
+    # После decrypt pycryptodome запрещает encrypt, поэтому при выровненном смещении шифр не трогаем
+    if offset % AES.block_size:
+        cipher.decrypt(bytes(offset % AES.block_size))
+
+    return cipher
+
+
+def decrypt_stream(aes_key: bytes,
+                   iv: bytes,
+                   offset: int,
+                   chunks: Iterable[bytes]) -> Iterator[bytes]:
+    decipher = get_ctr_cipher(aes_key, iv, offset)
+
+    for chunk in chunks:
+        yield decipher.decrypt(chunk)
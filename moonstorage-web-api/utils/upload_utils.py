@@ -0,0 +1,88 @@
+import hashlib
+import uuid
+from typing import AsyncIterator, BinaryIO, Iterator
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+from utils import security_utils
+
+BUF_SIZE = 1024 * 1024
+
+
+class EncryptedUpload:
+    def __init__(self, source: BinaryIO, aes_key: bytes, filename: str = 'file'):
+        self.__source = source
+        self.__aes_key = aes_key
+        self.__filename = filename
+        self.__boundary = uuid.uuid4().hex
+
+        self.__sha256 = hashlib.sha256()
+        self.__file_size = 0
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.__boundary}'
+
+    @property
+    def file_hash(self) -> str:
+        return self.__sha256.hexdigest()
+
+    @property
+    def file_size(self) -> int:
+        return self.__file_size
+
+    def multipart_body(self) -> Iterator[bytes]:
+        # Исходный поток читается один раз: хеш и шифрование считаются по одним и тем же блокам
+        yield self._get_head()
+
+        yield from security_utils.encrypt_stream(self.__aes_key, self.__read_source())
+
+        yield self._get_tail()
+
+    def _get_head(self) -> bytes:
+        return (f'--{self.__boundary}\r\n'
+                f'Content-Disposition: form-data; name="file"; filename="{self.__filename}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+
+    def _get_tail(self) -> bytes:
+        return f'\r\n--{self.__boundary}--\r\n'.encode('utf-8')
+
+    def _account(self, chunk: bytes) -> None:
+        self.__sha256.update(chunk)
+        self.__file_size += len(chunk)
+
+    def __read_source(self) -> Iterator[bytes]:
+        while True:
+            chunk = self.__source.read(BUF_SIZE)
+
+            if not chunk:
+                break
+
+            self._account(chunk)
+
+            yield chunk
+
+
+class AsyncEncryptedUpload(EncryptedUpload):
+    def __init__(self, source: AsyncIterator[bytes], aes_key: bytes, filename: str = 'file'):
+        super().__init__(None, aes_key, filename)
+
+        self.__source = source
+        self.__aes_key = aes_key
+
+    async def multipart_body(self) -> AsyncIterator[bytes]:
+        yield self._get_head()
+
+        # Формат совпадает с encrypt_stream: IV, затем зашифрованное содержимое
+        iv = get_random_bytes(AES.block_size)
+        cipher = security_utils.get_ctr_cipher(self.__aes_key, iv)
+
+        yield iv
+
+        async for chunk in self.__source:
+            self._account(chunk)
+
+            yield cipher.encrypt(chunk)
+
+        yield self._get_tail()
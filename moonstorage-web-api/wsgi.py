@@ -5,4 +5,4 @@ from api import app
 if __name__ == "__main__":
     app.run()
 
-    shutil.rmtree(app.config['UPLOAD_FOLDER'])
+    shutil.rmtree(app.config['UPLOAD_FOLDER'], ignore_errors=True)
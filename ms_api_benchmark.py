@@ -0,0 +1,97 @@
+import argparse
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import requests
+
+
+def make_session(args) -> requests.Session:
+    session = requests.Session()
+
+    response = session.put(f'{args.url}/init', data={'username': args.username,
+                                                     'password': args.password,
+                                                     'db_host': args.db_host,
+                                                     'db_port': args.db_port,
+                                                     'ipfs_rpc_url': args.ipfs_rpc_url,
+                                                     'ipfs_api_url': args.ipfs_api_url})
+
+    if response.status_code != 200:
+        raise Exception(f'Не удалось авторизоваться: {response.content}')
+
+    return session
+
+
+def get_request(args) -> tuple[str, dict]:
+    if args.endpoint == 'health':
+        return f'{args.url}/health', dict()
+    elif args.endpoint == 'resolve':
+        return f'{args.url}/fuse/resolve', {'path': args.path}
+    elif args.endpoint == 'download':
+        return f'{args.url}/download/{args.cid}', {'offset': 0, 'chunk_size': args.chunk_size}
+
+    return f'{args.url}/download/{args.cid}', dict()
+
+
+def run_benchmark(args) -> None:
+    url, params = get_request(args)
+
+    # Отдельная сессия на поток: requests.Session не предназначена для одновременного использования
+    local = threading.local()
+
+    def _request() -> tuple[float, int, int]:
+        if not hasattr(local, 'session'):
+            local.session = make_session(args)
+
+        started_at = perf_counter()
+
+        response = local.session.get(url, params=params)
+
+        return (perf_counter() - started_at) * 1000, response.status_code, len(response.content)
+
+    print(f'Running {args.requests} requests to {url} with concurrency {args.concurrency}...')
+
+    started_at = perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda _: _request(), range(args.requests)))
+
+    elapsed = perf_counter() - started_at
+
+    timings = [timing for timing, _, _ in results]
+    errors = sum(1 for _, status_code, _ in results if status_code >= 400)
+    transferred = sum(size for _, _, size in results)
+
+    print(f'requests/s: {len(results) / elapsed:10.1f}  '
+          f'MiB/s: {transferred / elapsed / 1024 / 1024:8.2f}  '
+          f'avg: {statistics.mean(timings):8.3f} ms  '
+          f'p95: {statistics.quantiles(timings, n=20)[-1]:8.3f} ms  '
+          f'errors: {errors}')
+
+
+def start_cli() -> None:
+    parser = argparse.ArgumentParser(description='Нагрузочный бенчмарк API MoonStorage '
+                                                 'для сравнения моделей воркеров gunicorn.')
+
+    parser.add_argument('-url', dest='url', default='http://localhost:5000')
+    parser.add_argument('-user', dest='username')
+    parser.add_argument('-password', dest='password')
+    parser.add_argument('-db-host', dest='db_host', default='172.17.0.1')
+    parser.add_argument('-db-port', dest='db_port', default='5432')
+    parser.add_argument('-ipfs-rpc-url', dest='ipfs_rpc_url', default='http://172.17.0.1:5002')
+    parser.add_argument('-ipfs-api-url', dest='ipfs_api_url', default='http://172.17.0.1:8081')
+
+    parser.add_argument('--endpoint', dest='endpoint', default='download',
+                        choices=('health', 'resolve', 'download', 'stream'))
+    parser.add_argument('--path', dest='path', help='Путь для --endpoint resolve, например /role/file.txt')
+    parser.add_argument('--cid', dest='cid', help='CID файла для --endpoint download и stream')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=128 * 1024)
+    parser.add_argument('--requests', dest='requests', type=int, default=2000)
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=32)
+
+    run_benchmark(parser.parse_args())
+
+
+if __name__ == '__main__':
+    start_cli()
@@ -0,0 +1,169 @@
+import argparse
+import random
+import statistics
+from time import perf_counter
+
+import psycopg2
+
+BENCHMARK_ROLE = 'benchmark_role'
+
+queries = {
+    # /fuse/info, /fuse/file/exists: текущая версия файла
+    'latest (registry_latest)': ('select file_size, uploaded_at, cid from registry_latest '
+                                 'where role=%(role)s and name=%(name)s and directory=%(directory)s'),
+    'latest (sorted registry)': ('select file_size, uploaded_at, cid from registry '
+                                 'where role=%(role)s and name=%(name)s and directory=%(directory)s '
+                                 'order by uploaded_at desc limit 1'),
+    # /delete, /rename, /move: все версии файла
+    'all versions': ('select count(*) from registry '
+                     'where role=%(role)s and name=%(name)s and directory=%(directory)s'),
+    'directory lookup': ('select id from directories '
+                         'where role=%(role)s and name=%(directory_name)s and parent_directory is null'),
+}
+
+
+def seed(cursor, rows: int, directories: int, versions: int) -> None:
+    print(f'Seeding {rows} rows in {directories} directories...')
+
+    cursor.execute('insert into roles(name) values(%s) on conflict do nothing', (BENCHMARK_ROLE,))
+    cursor.execute('insert into roles_mapping(username, role) '
+                   'select current_user, %s where not exists('
+                   '    select 1 from roles_mapping where username=current_user and role=%s)',
+                   (BENCHMARK_ROLE, BENCHMARK_ROLE))
+
+    # Триггеры проверки ролей и поддержки registry_current отключаются на время массовой вставки
+    cursor.execute('set session_replication_role = replica')
+
+    cursor.execute('insert into directories_data(name, role) '
+                   'select %s || i, %s from generate_series(1, %s) as i',
+                   ('dir_', BENCHMARK_ROLE, directories))
+
+    cursor.execute('insert into registry_data(cid, name, secret_key, owned_by, role, file_size, file_hash, '
+                   '                          uploaded_at, directory) '
+                   'select md5(i::text), %s || (i / %s), %s, current_user, %s, i, md5(i::text), '
+                   '       now() - (i %% %s) * interval %s, '
+                   '       (select min(id) from directories_data where role=%s) + (i / %s) %% %s '
+                   'from generate_series(1, %s) as i',
+                   ('file_', versions, psycopg2.Binary(b'0' * 32), BENCHMARK_ROLE,
+                    versions, '1 minute',
+                    BENCHMARK_ROLE, versions, directories,
+                    rows))
+
+    cursor.execute('set session_replication_role = origin')
+
+    cursor.execute('insert into registry_current(role, directory, name, registry_id) '
+                   'select distinct on (role, directory, name) role, directory, name, id '
+                   'from registry_data where role=%s '
+                   'order by role, directory, name, uploaded_at desc, id desc '
+                   'on conflict do nothing', (BENCHMARK_ROLE,))
+
+    cursor.execute('analyze registry_data')
+    cursor.execute('analyze directories_data')
+    cursor.execute('analyze registry_current')
+
+
+def cleanup(cursor) -> None:
+    print('Removing benchmark data...')
+
+    cursor.execute('delete from registry_current where role=%s', (BENCHMARK_ROLE,))
+    cursor.execute('delete from directory_versions where role=%s', (BENCHMARK_ROLE,))
+    cursor.execute('set session_replication_role = replica')
+    cursor.execute('delete from registry_data where role=%s', (BENCHMARK_ROLE,))
+    cursor.execute('delete from directories_data where role=%s', (BENCHMARK_ROLE,))
+    cursor.execute('set session_replication_role = origin')
+    cursor.execute('delete from roles_mapping where username=current_user and role=%s', (BENCHMARK_ROLE,))
+    cursor.execute('delete from roles where name=%s', (BENCHMARK_ROLE,))
+
+
+def run_queries(cursor, rows: int, directories: int, versions: int, iterations: int) -> None:
+    cursor.execute('select min(id) from directories_data where role=%s', (BENCHMARK_ROLE,))
+
+    first_directory_id = cursor.fetchone()[0]
+
+    for query_name, query in queries.items():
+        timings = []
+
+        for _ in range(iterations):
+            i = random.randint(1, rows)
+            directory_offset = (i // versions) % directories
+
+            params = {'role': BENCHMARK_ROLE,
+                      'name': f'file_{i // versions}',
+                      'directory': first_directory_id + directory_offset,
+                      'directory_name': f'dir_{directory_offset + 1}'}
+
+            started_at = perf_counter()
+
+            cursor.execute(query, params)
+            cursor.fetchall()
+
+            timings.append((perf_counter() - started_at) * 1000)
+
+        print(f'{query_name:<28} avg: {statistics.mean(timings):8.3f} ms  '
+              f'p95: {statistics.quantiles(timings, n=20)[-1]:8.3f} ms')
+
+
+def run_writes(cursor, rows: int, directories: int, versions: int, iterations: int) -> None:
+    # Загрузка новой версии идет с включенными триггерами: проверка роли, registry_current,
+    # версии папок и уведомления, в отличие от seed
+    cursor.execute('select min(id) from directories_data where role=%s', (BENCHMARK_ROLE,))
+
+    first_directory_id = cursor.fetchone()[0]
+
+    for write_name, in_root in (('upload (directory)', False), ('upload (root)', True)):
+        timings = []
+
+        for _ in range(iterations):
+            i = random.randint(1, rows)
+
+            params = {'role': BENCHMARK_ROLE,
+                      'name': f'file_{i // versions}',
+                      'directory': None if in_root else first_directory_id + (i // versions) % directories}
+
+            started_at = perf_counter()
+
+            cursor.execute('insert into registry_data(cid, name, secret_key, owned_by, role, file_size, file_hash, '
+                           '                          directory) '
+                           'values(md5(random()::text), %(name)s, %(secret_key)s, current_user, %(role)s, 0, '
+                           '       md5(random()::text), %(directory)s)',
+                           {**params, 'secret_key': psycopg2.Binary(b'0' * 32)})
+
+            timings.append((perf_counter() - started_at) * 1000)
+
+        print(f'{write_name:<28} avg: {statistics.mean(timings):8.3f} ms  '
+              f'p95: {statistics.quantiles(timings, n=20)[-1]:8.3f} ms')
+
+
+def start_cli() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк запросов к registry для MoonStorage.')
+
+    parser.add_argument('-user', dest='username')
+    parser.add_argument('-password', dest='password')
+    parser.add_argument('-host', dest='host', default='localhost')
+    parser.add_argument('-port', dest='port', default=5432)
+
+    parser.add_argument('--rows', dest='rows', type=int, default=1_000_000)
+    parser.add_argument('--directories', dest='directories', type=int, default=1000)
+    parser.add_argument('--versions', dest='versions', type=int, default=3)
+    parser.add_argument('--iterations', dest='iterations', type=int, default=1000)
+    parser.add_argument('--keep', dest='keep', action='store_true')
+
+    args = parser.parse_args()
+
+    with psycopg2.connect(dbname="ipfs", user=args.username, password=args.password,
+                          host=args.host, port=args.port) as connection:
+        with connection.cursor() as cursor:
+            seed(cursor, args.rows, args.directories, args.versions)
+
+            connection.commit()
+
+            try:
+                run_queries(cursor, args.rows, args.directories, args.versions, args.iterations)
+                run_writes(cursor, args.rows, args.directories, args.versions, args.iterations)
+            finally:
+                if not args.keep:
+                    cleanup(cursor)
+
+
+if __name__ == '__main__':
+    start_cli()
@@ -36,10 +36,12 @@ def upload_file(api_url: str, session: requests.Session, user_input: str) -> Non
 def download_file(api_url: str, session: requests.Session, user_input: str):
     cid, dst_file = user_input.split(' ')[1], ''.join(user_input.split(' ')[2:])
 
-    with open(dst_file, 'wb') as f:
-        response = session.get(f'{api_url}/download/{cid}')
+    with session.get(f'{api_url}/download/{cid}', stream=True) as response:
+        response.raise_for_status()
 
-        f.write(response.content)
+        with open(dst_file, 'wb') as f:
+            for chunk in response.iter_content(1024 * 1024):
+                f.write(chunk)
 
 
 commands_dict = {
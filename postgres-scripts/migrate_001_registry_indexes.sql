@@ -0,0 +1,151 @@
+-- Индексы для горячих запросов и таблица текущих версий файлов.
+-- Скрипт идемпотентен: на новой базе выполняется после init_tables.sql,
+-- на существующей его можно запустить вручную.
+
+create index if not exists registry_data_lookup_idx
+    on registry_data(role, directory, name, uploaded_at desc);
+
+create index if not exists registry_data_root_lookup_idx
+    on registry_data(role, name, uploaded_at desc)
+    where directory is null;
+
+create index if not exists registry_data_cid_idx
+    on registry_data(cid, uploaded_at desc);
+
+create index if not exists directories_data_lookup_idx
+    on directories_data(role, parent_directory, name);
+
+create index if not exists directories_data_root_lookup_idx
+    on directories_data(role, name)
+    where parent_directory is null;
+
+create index if not exists directories_data_parent_idx
+    on directories_data(parent_directory);
+
+create index if not exists roles_mapping_username_idx
+    on roles_mapping(username, role);
+
+-- Последняя версия файла для каждого (role, directory, name)
+create table if not exists registry_current (
+    role varchar not null,
+    directory integer,
+    name varchar not null,
+    registry_id bigint not null,
+    foreign key(registry_id) references registry_data(id) on delete cascade
+);
+
+create unique index if not exists registry_current_key_idx
+    on registry_current(role, directory, name)
+    where directory is not null;
+
+create unique index if not exists registry_current_root_key_idx
+    on registry_current(role, name)
+    where directory is null;
+
+-- security definer выполняется с правами владельца: search_path закреплен, а pg_temp стоит последним,
+-- иначе временная таблица вызывающего с тем же именем подменила бы настоящую
+create or replace function refresh_registry_current(key_role varchar, key_directory integer, key_name varchar)
+returns void as $refresh$
+	begin
+		-- Сериализуем обновления одного ключа, чтобы параллельные загрузки не нарушили уникальность
+		perform pg_advisory_xact_lock(hashtext(key_role || '/' || coalesce(key_directory::text, '') || '/' || key_name));
+
+		-- Ветки вместо is not distinct from: так планировщик использует частичные индексы для корня и папок
+		if key_directory is null then
+			delete from registry_current
+			where role = key_role and directory is null and name = key_name;
+
+			insert into registry_current(role, directory, name, registry_id)
+			select role, directory, name, id from registry_data
+			where role = key_role and directory is null and name = key_name
+			order by uploaded_at desc, id desc
+			limit 1;
+		else
+			delete from registry_current
+			where role = key_role and directory = key_directory and name = key_name;
+
+			insert into registry_current(role, directory, name, registry_id)
+			select role, directory, name, id from registry_data
+			where role = key_role and directory = key_directory and name = key_name
+			order by uploaded_at desc, id desc
+			limit 1;
+		end if;
+	end;
+$refresh$ language plpgsql security definer
+set search_path = public, pg_temp;
+
+-- Функция выполняется с правами владельца, поэтому вызывать ее напрямую могут только триггеры
+revoke execute on function refresh_registry_current(varchar, integer, varchar) from public;
+
+create or replace function maintain_registry_current() returns trigger as $maintain$
+	begin
+		if tg_op in ('UPDATE', 'DELETE') then
+			perform refresh_registry_current(old.role, old.directory, old.name);
+		end if;
+
+		if tg_op in ('INSERT', 'UPDATE') then
+			perform refresh_registry_current(new.role, new.directory, new.name);
+		end if;
+
+		return null;
+	end;
+$maintain$ language plpgsql security definer
+set search_path = public, pg_temp;
+
+drop trigger if exists maintain_registry_current_after_change on registry_data;
+
+create trigger maintain_registry_current_after_change
+after insert or delete or update of role, directory, name, uploaded_at on registry_data
+for each row execute procedure maintain_registry_current();
+
+insert into registry_current(role, directory, name, registry_id)
+select distinct on (role, directory, name) role, directory, name, id
+from registry_data
+order by role, directory, name, uploaded_at desc, id desc
+on conflict do nothing;
+
+-- array(...) вычисляется один раз на запрос, а не для каждой строки
+CREATE OR REPLACE VIEW registry
+AS SELECT cid,
+    name,
+    secret_key,
+    owned_by,
+    role,
+    file_size,
+    file_hash,
+    uploaded_at,
+    directory
+   FROM registry_data rg
+  WHERE rg.role::text = any(array(select role from user_roles));
+
+create or replace view directories
+as select name,
+    id,
+    parent_directory,
+    role
+   from directories_data dd
+  where dd.role::text = any(array(select role from user_roles));
+
+CREATE OR REPLACE VIEW registry_latest
+AS SELECT rg.cid,
+    rc.name,
+    rg.secret_key,
+    rg.owned_by,
+    rc.role,
+    rg.file_size,
+    rg.file_hash,
+    rg.uploaded_at,
+    rc.directory
+   FROM registry_current rc
+   JOIN registry_data rg ON rg.id = rc.registry_id
+  WHERE rc.role::text = any(array(select role from user_roles));
+
+do $grant$
+	declare
+		role_name varchar;
+	begin
+		for role_name in select name from roles loop
+			execute format('grant select on table registry_latest to %I', role_name);
+		end loop;
+	end;
+$grant$;
@@ -0,0 +1,82 @@
+-- Счетчик версий содержимого каждой папки, используется как ETag для метаданных FUSE.
+-- Корень роли хранится с directory_id = 0.
+
+create table if not exists directory_versions (
+    role varchar not null,
+    directory_id bigint not null,
+    version bigint not null default 0,
+    primary key(role, directory_id)
+);
+
+-- search_path закреплен, как и в migrate_001: временная directory_versions не должна перехватывать версии
+create or replace function bump_directory_version(key_role varchar, key_directory bigint)
+returns void as $bump$
+	begin
+		insert into directory_versions(role, directory_id, version)
+		values(key_role, coalesce(key_directory, 0), 1)
+		on conflict (role, directory_id) do update set version = directory_versions.version + 1;
+	end;
+$bump$ language plpgsql security definer
+set search_path = public, pg_temp;
+
+-- Вызывается только из триггеров: иначе любой пользователь мог бы сдвигать версии чужих ролей
+revoke execute on function bump_directory_version(varchar, bigint) from public;
+
+create or replace function bump_directory_version_for_file() returns trigger as $bump_file$
+	begin
+		if tg_op in ('UPDATE', 'DELETE') then
+			perform bump_directory_version(old.role, old.directory);
+		end if;
+
+		if tg_op in ('INSERT', 'UPDATE') then
+			perform bump_directory_version(new.role, new.directory);
+		end if;
+
+		return null;
+	end;
+$bump_file$ language plpgsql security definer
+set search_path = public, pg_temp;
+
+create or replace function bump_directory_version_for_directory() returns trigger as $bump_directory$
+	begin
+		if tg_op in ('UPDATE', 'DELETE') then
+			perform bump_directory_version(old.role, old.parent_directory);
+		end if;
+
+		if tg_op in ('INSERT', 'UPDATE') then
+			perform bump_directory_version(new.role, new.parent_directory);
+		end if;
+
+		return null;
+	end;
+$bump_directory$ language plpgsql security definer
+set search_path = public, pg_temp;
+
+drop trigger if exists bump_directory_version_after_file_change on registry_data;
+
+create trigger bump_directory_version_after_file_change
+after insert or delete or update on registry_data
+for each row execute procedure bump_directory_version_for_file();
+
+drop trigger if exists bump_directory_version_after_directory_change on directories_data;
+
+create trigger bump_directory_version_after_directory_change
+after insert or delete or update on directories_data
+for each row execute procedure bump_directory_version_for_directory();
+
+create or replace view user_directory_versions
+as select role,
+    directory_id,
+    version
+   from directory_versions dv
+  where dv.role::text = any(array(select role from user_roles));
+
+do $grant$
+	declare
+		role_name varchar;
+	begin
+		for role_name in select name from roles loop
+			execute format('grant select on table user_directory_versions to %I', role_name);
+		end loop;
+	end;
+$grant$;
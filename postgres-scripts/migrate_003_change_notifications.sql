@@ -0,0 +1,69 @@
+-- Уведомления об изменениях метаданных для /fuse/changes.
+-- LISTEN доступен любому пользователю базы, поэтому в уведомлении только роль и id папок, без имен файлов.
+
+create or replace function notify_file_change() returns trigger as $notify_file$
+	declare
+		changed_row registry_data;
+	begin
+		if tg_op = 'DELETE' then
+			changed_row = old;
+		else
+			changed_row = new;
+		end if;
+
+		perform pg_notify('moonstorage_changes', json_build_object(
+			'op', lower(tg_op),
+			'kind', 'file',
+			'role', changed_row.role,
+			'directory', changed_row.directory,
+			'old_directory', case when tg_op = 'UPDATE' then old.directory end
+		)::text);
+
+		if tg_op = 'UPDATE' and old.role <> new.role then
+			perform pg_notify('moonstorage_changes', json_build_object(
+				'op', 'delete',
+				'kind', 'file',
+				'role', old.role,
+				'directory', old.directory,
+				'old_directory', null
+			)::text);
+		end if;
+
+		return null;
+	end;
+$notify_file$ language plpgsql;
+
+create or replace function notify_directory_change() returns trigger as $notify_directory$
+	declare
+		changed_row directories_data;
+	begin
+		if tg_op = 'DELETE' then
+			changed_row = old;
+		else
+			changed_row = new;
+		end if;
+
+		perform pg_notify('moonstorage_changes', json_build_object(
+			'op', lower(tg_op),
+			'kind', 'directory',
+			'role', changed_row.role,
+			'id', changed_row.id,
+			'directory', changed_row.parent_directory,
+			'old_directory', case when tg_op = 'UPDATE' then old.parent_directory end
+		)::text);
+
+		return null;
+	end;
+$notify_directory$ language plpgsql;
+
+drop trigger if exists notify_file_change_after_change on registry_data;
+
+create trigger notify_file_change_after_change
+after insert or delete or update on registry_data
+for each row execute procedure notify_file_change();
+
+drop trigger if exists notify_directory_change_after_change on directories_data;
+
+create trigger notify_directory_change_after_change
+after insert or delete or update on directories_data
+for each row execute procedure notify_directory_change();
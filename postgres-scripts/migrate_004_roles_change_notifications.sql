@@ -0,0 +1,19 @@
+-- Уведомление об изменении назначений ролей: каждый процесс API сбрасывает по нему кэши ролей и ключей файлов.
+-- Имя пользователя в уведомление не попадает: назначения ролей меняются редко, кэши сбрасываются целиком
+
+create or replace function notify_roles_change() returns trigger as $notify_roles$
+	begin
+		perform pg_notify('moonstorage_changes', json_build_object(
+			'op', lower(tg_op),
+			'kind', 'roles'
+		)::text);
+
+		return null;
+	end;
+$notify_roles$ language plpgsql;
+
+drop trigger if exists notify_roles_change_after_change on roles_mapping;
+
+create trigger notify_roles_change_after_change
+after insert or delete or update on roles_mapping
+for each statement execute procedure notify_roles_change();